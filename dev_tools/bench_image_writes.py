@@ -0,0 +1,92 @@
+"""
+Benchmark how fast image worker threads can record their results:
+legacy per-image session + commit vs. the single BatchWriter in ebay_migration/writer.py.
+
+No network: each "download" is a short sleep standing in for the transfer, so
+the numbers show the DB ceiling on images/s as threads are added.
+
+Usage: python dev_tools/bench_image_writes.py [--images 5000] [--threads 4 16 32] [--latency-ms 5]
+Uses throwaway SQLite files in a temp directory; the real DB is not touched.
+"""
+import argparse
+import concurrent.futures
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ebay_migration'))
+
+from sqlalchemy import insert
+from sqlalchemy.orm import sessionmaker
+from db import init_db, Listing, ListingImage
+from writer import BatchWriter
+
+def make_db(path, count):
+    engine = init_db(f"sqlite:///{path}")
+    SessionLocal = sessionmaker(bind=engine)
+    db = SessionLocal()
+    listing = Listing(item_id='1', title='Benchmark')
+    db.add(listing)
+    db.flush()
+    db.execute(insert(ListingImage), [
+        {'listing_id': listing.id, 'original_url': f"https://i.ebayimg.com/images/g/{i}/s-l500.jpg", 'rank': i}
+        for i in range(count)
+    ])
+    db.commit()
+    ids = [row[0] for row in db.query(ListingImage.id)]
+    db.close()
+    return SessionLocal, ids
+
+def legacy_worker(SessionLocal, img_id, latency):
+    """The original pattern: own session, get() to read, get() to write, commit."""
+    db = SessionLocal()
+    try:
+        img = db.get(ListingImage, img_id)
+        time.sleep(latency)
+        row = db.get(ListingImage, img_id)
+        row.local_path = f"data/images/blobs/{img.id:064d}.jpg"
+        row.content_sha256 = f"{img.id:064d}"
+        db.commit()
+    finally:
+        db.close()
+
+def batched_worker(writer, img_id, latency):
+    time.sleep(latency)
+    writer.put([{'id': img_id, 'local_path': f"data/images/blobs/{img_id:064d}.jpg", 'content_sha256': f"{img_id:064d}"}])
+
+def run(label, tmpdir, count, threads, latency):
+    SessionLocal, ids = make_db(os.path.join(tmpdir, f"{label}_{threads}.db"), count)
+    start = time.perf_counter()
+    if label == 'legacy':
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(lambda i: legacy_worker(SessionLocal, i, latency), ids))
+        commits = count
+    else:
+        with BatchWriter(SessionLocal) as writer, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(lambda i: batched_worker(writer, i, latency), ids))
+        commits = writer.commits
+    elapsed = time.perf_counter() - start
+
+    db = SessionLocal()
+    saved = db.query(ListingImage).filter(ListingImage.local_path != None).count()
+    db.close()
+    print(f"  {label:<8} {threads:>3} threads  {elapsed:7.2f}s  {count / elapsed:8.0f} images/s  "
+          f"{commits:>6} commits  ({saved}/{count} saved)")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=5000)
+    parser.add_argument('--threads', type=int, nargs='+', default=[4, 16, 32])
+    parser.add_argument('--latency-ms', type=float, default=5.0, help="Simulated transfer time per image")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        print(f"{args.images} images, {args.latency_ms} ms simulated transfer each")
+        for threads in args.threads:
+            run('legacy', tmpdir, args.images, threads, args.latency_ms / 1000)
+            run('batched', tmpdir, args.images, threads, args.latency_ms / 1000)
+
+if __name__ == "__main__":
+    main()
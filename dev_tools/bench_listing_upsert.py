@@ -0,0 +1,90 @@
+"""
+Benchmark listing persistence: legacy per-row path (query + flush per item)
+vs. the bulk upsert path in ebay_migration/bulk.py.
+
+Usage: python dev_tools/bench_listing_upsert.py [--sizes 10000 100000] [--skip-legacy]
+Uses throwaway SQLite files in a temp directory; the real DB is not touched.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ebay_migration'))
+
+from sqlalchemy.orm import Session
+from db import init_db, Listing, ListingImage
+from bulk import upsert_listings
+from listings import listing_row, picture_urls, compute_content_hash
+
+def fake_item(i):
+    return {
+        'ItemID': str(100000000000 + i),
+        'SKU': f"SKU-{i}",
+        'Title': f"Benchmark listing {i}",
+        'Description': "<div>" + "Lorem ipsum dolor sit amet. " * 40 + "</div>",
+        'Quantity': '3',
+        'SellingStatus': {'CurrentPrice': {'value': '19.99'}, 'QuantitySold': '1'},
+        'PrimaryCategory': {'CategoryID': '261186'},
+        'ConditionID': '3000',
+        'ItemSpecifics': {'NameValueList': [
+            {'Name': 'Author', 'Value': 'Someone'},
+            {'Name': 'Topic', 'Value': ['History', 'Art']},
+        ]},
+        'PictureDetails': {'PictureURL': [f"https://i.ebayimg.com/images/g/{i}/{n}/s-l500.jpg" for n in range(3)]},
+    }
+
+def legacy_save(db, items):
+    """The original per-item persistence pattern."""
+    for item in items:
+        row = listing_row(item, compute_content_hash(item))
+        existing = db.query(Listing).filter_by(item_id=row['item_id']).first()
+        if existing:
+            continue
+        listing = Listing(**row)
+        db.add(listing)
+        db.flush()
+        for rank, url in enumerate(picture_urls(item)):
+            db.add(ListingImage(listing_id=listing.id, original_url=url, rank=rank))
+    db.commit()
+
+def bulk_save(db, items, page_size=200):
+    """Bulk path, fed page by page like extract_active_listings does."""
+    for start in range(0, len(items), page_size):
+        page = items[start:start + page_size]
+        rows = []
+        urls = {}
+        for item in page:
+            row = listing_row(item, compute_content_hash(item))
+            rows.append(row)
+            urls[row['item_id']] = picture_urls(item)
+        upsert_listings(db, rows, urls)
+        db.commit()
+
+def run(label, save_fn, items, tmpdir):
+    path = os.path.join(tmpdir, f"{label}_{len(items)}.db")
+    db = Session(init_db(f"sqlite:///{path}"))
+    start = time.perf_counter()
+    save_fn(db, items)
+    elapsed = time.perf_counter() - start
+    db.close()
+    print(f"  {label:<8} {len(items):>7} rows  {elapsed:8.2f}s  {len(items) / elapsed:10.0f} rows/s")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--skip-legacy', action='store_true', help="Only time the bulk path")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in args.sizes:
+            print(f"\n=== {size} listings ({size * 3} images) ===")
+            items = [fake_item(i) for i in range(size)]
+            if not args.skip_legacy:
+                run('legacy', legacy_save, items, tmpdir)
+            run('bulk', bulk_save, items, tmpdir)
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 from sqlalchemy.orm import Session
 from ebay_migration.db import init_db, Listing
+from ebay_migration.archive import load_raw_listing
 import json
 
 def debug_item():
@@ -16,7 +17,7 @@ def debug_item():
         return
 
     print(f"--- Debugging {sku} ---")
-    raw = item.raw_listing_json or {}
+    raw = load_raw_listing(item)
     
     pkg = raw.get('ShippingPackageDetails')
     print(f"ShippingPackageDetails: {json.dumps(pkg, indent=2)}")
@@ -1,5 +1,6 @@
 from sqlalchemy.orm import Session
 from ebay_migration.db import init_db, Listing
+from ebay_migration.archive import load_raw_listing
 import json
 import os
 
@@ -14,7 +15,7 @@ engine = init_db()
 db = Session(engine)
 
 item = db.query(Listing).filter_by(sku='YOUR_SKU_HERE').first()
-raw = item.raw_listing_json
+raw = load_raw_listing(item)
 pkg = raw['ShippingPackageDetails']
 if isinstance(pkg, list): pkg = pkg[0]
 
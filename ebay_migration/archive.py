@@ -0,0 +1,107 @@
+import gzip
+import json
+import os
+import re
+import socket
+import threading
+
+ARCHIVE_DIR = "data/raw_archive"
+
+# Start a new segment once the current one passes this size
+SEGMENT_MAX_BYTES = 256 * 1024 * 1024
+
+# Each process appends to its own segments, so several workers can share
+# ARCHIVE_DIR without one's offsets pointing into another's records
+WRITER_ID = re.sub(r'[^A-Za-z0-9_.-]', '-', os.getenv("EBAY_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}")
+
+class RawArchive:
+    """
+    Append-only store for raw Trading API payloads.
+
+    Records are JSON lines, each compressed as its own gzip member and appended
+    to numbered segment files named after the writing process (WRITER_ID). A record is addressed by a short pointer
+    "<segment>:<offset>:<length>" kept on the Listing row, so a single payload
+    can be read back with one seek without decompressing the whole segment.
+    Concatenated members are still a valid .gz file: `zcat segment-*.jsonl.gz`
+    yields every record ({"item_id": ..., "raw": {...}}) for rebuilds.
+    """
+
+    def __init__(self, root=ARCHIVE_DIR, segment_max_bytes=SEGMENT_MAX_BYTES, writer_id=WRITER_ID):
+        self.root = root
+        self.segment_max_bytes = segment_max_bytes
+        self.writer_id = writer_id
+        self._segment_re = re.compile(rf'^segment-{re.escape(writer_id)}-(\d+)\.jsonl\.gz$')
+        self._lock = threading.Lock()
+        self._handle = None
+        self._segment = None
+
+    def _latest_segment(self):
+        numbers = [
+            int(m.group(1)) for m in (self._segment_re.match(n) for n in os.listdir(self.root)) if m
+        ]
+        return max(numbers) if numbers else 1
+
+    def _segment_name(self, number):
+        return f"segment-{self.writer_id}-{number:05d}.jsonl.gz"
+
+    def _open_for_append(self):
+        os.makedirs(self.root, exist_ok=True)
+        if self._segment is None:
+            self._segment = self._latest_segment()
+        path = os.path.join(self.root, self._segment_name(self._segment))
+        if os.path.exists(path) and os.path.getsize(path) >= self.segment_max_bytes:
+            self._segment += 1
+            path = os.path.join(self.root, self._segment_name(self._segment))
+        self._handle = open(path, 'ab')
+
+    def append(self, item_id, payload):
+        """Append one payload and return its pointer."""
+        line = json.dumps({'item_id': item_id, 'raw': payload}, default=str) + "\n"
+        blob = gzip.compress(line.encode('utf-8'))
+        with self._lock:
+            if self._handle is None or self._handle.tell() >= self.segment_max_bytes:
+                self.close()
+                self._open_for_append()
+            offset = self._handle.tell()
+            self._handle.write(blob)
+            return f"{self._segment_name(self._segment)}:{offset}:{len(blob)}"
+
+    def flush(self):
+        """Make appended records durable. Call before committing their pointers."""
+        with self._lock:
+            if self._handle is not None:
+                self._handle.flush()
+                os.fsync(self._handle.fileno())
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def load(self, ref):
+        segment, offset, length = ref.rsplit(':', 2)
+        path = os.path.join(self.root, segment)
+        if not os.path.exists(path):
+            # Written by a worker on another host: workers must share the data/ directory
+            raise FileNotFoundError(f"Raw archive segment {path} not found (is {self.root} shared by every worker?)")
+        with open(path, 'rb') as f:
+            f.seek(int(offset))
+            blob = f.read(int(length))
+        return json.loads(gzip.decompress(blob))['raw']
+
+_default_archive = None
+
+def get_archive():
+    global _default_archive
+    if _default_archive is None:
+        _default_archive = RawArchive()
+    return _default_archive
+
+def load_raw_listing(listing):
+    """
+    Full source payload for a listing: from the archive when it has a pointer,
+    otherwise the legacy inline raw_listing_json column.
+    """
+    if listing.raw_archive_ref:
+        return get_archive().load(listing.raw_archive_ref)
+    return listing.raw_listing_json or {}
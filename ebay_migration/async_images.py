@@ -0,0 +1,130 @@
+"""
+asyncio download engine for Step 2 (selected with EBAY_DOWNLOAD_MODE=async).
+
+Keeps hundreds of transfers in flight on a single thread with per-host connection
+limits. Workers never touch the DB: results go to the shared BatchWriter
+(writer.py), so there is no per-image session or commit.
+"""
+import asyncio
+import hashlib
+import os
+import time
+
+import aiohttp
+from db import SessionLocal
+from writer import BatchWriter
+from images import (
+    TMP_DIR, DOWNLOAD_CHUNK_SIZE, WRITE_BUFFER_SIZE, DownloadError,
+    download_url_for, url_extension, store_blob, format_throughput,
+    partial_path, resume_headers, begin_partial, hash_partial, finish_partial,
+    discard_partial, content_range_total
+)
+
+ASYNC_DOWNLOAD_CONCURRENCY = int(os.getenv("EBAY_ASYNC_DOWNLOAD_CONCURRENCY", 200))
+ASYNC_PER_HOST_LIMIT = int(os.getenv("EBAY_ASYNC_PER_HOST_LIMIT", 50))
+DOWNLOAD_ATTEMPTS = 3
+
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+async def _fetch(session, url, part, img_id):
+    """
+    Download url into the .part file, resuming with Range like images.fetch_to_partial.
+    Re-hashing a resumed file, fsync and the final checks run in a thread, so
+    they don't stall every other transfer on the event loop.
+    Returns (part path, sha256, bytes transferred) or raises.
+    """
+    os.makedirs(TMP_DIR, exist_ok=True)
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        offset, headers = resume_headers(part)
+        try:
+            async with session.get(url, headers=headers) as resp:
+                if resp.status in _RETRY_STATUSES and attempt < DOWNLOAD_ATTEMPTS:
+                    await asyncio.sleep(0.5 * 2 ** attempt)
+                    continue
+                if resp.status == 416:
+                    if content_range_total(resp.headers) == offset:
+                        await asyncio.to_thread(finish_partial, part, offset, 416, resp.headers)
+                        sha = await asyncio.to_thread(hash_partial, part, offset)
+                        return part, sha.hexdigest(), 0
+                    discard_partial(part)
+                    continue
+                if resp.status not in (200, 206):
+                    raise RuntimeError(f"Failed {resp.status}: {url}")
+
+                mode, offset, expected_total = begin_partial(part, resp.status, resp.headers, offset)
+                sha = await asyncio.to_thread(hash_partial, part, offset)
+                md5 = hashlib.md5() if resp.status == 200 and resp.headers.get('Content-MD5') else None
+                transferred = 0
+                with open(part, mode, buffering=WRITE_BUFFER_SIZE) as f:
+                    async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        sha.update(chunk)
+                        if md5:
+                            md5.update(chunk)
+                        transferred += len(chunk)
+                    f.flush()
+                    await asyncio.to_thread(os.fsync, f.fileno())
+                await asyncio.to_thread(finish_partial, part, expected_total, resp.status, resp.headers, md5)
+                return part, sha.hexdigest(), transferred
+        except (aiohttp.ClientError, asyncio.TimeoutError, DownloadError) as e:
+            # Bytes already written stay in the .part file; the retry resumes from there
+            if attempt == DOWNLOAD_ATTEMPTS:
+                raise RuntimeError(f"Error {img_id}: {e}")
+            await asyncio.sleep(0.5 * 2 ** attempt)
+    raise RuntimeError(f"Error {img_id}: gave up after {DOWNLOAD_ATTEMPTS} attempts")
+
+async def _worker(session, work, writer, progress):
+    while True:
+        try:
+            img_ids, original_url, resolved_url = work.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        try:
+            download_url = download_url_for(original_url, resolved_url)
+            tmp_path, sha256, size = await _fetch(
+                session, download_url, partial_path(original_url, download_url), img_ids[0]
+            )
+            local_path = await asyncio.to_thread(store_blob, tmp_path, sha256, url_extension(original_url))
+            writer.put([
+                {'id': iid, 'local_path': local_path, 'content_sha256': sha256}
+                for iid in img_ids
+            ])
+            progress['downloaded'] += 1
+            progress['bytes'] += size
+            message = f"Success: {local_path}"
+        except Exception as e:
+            message = str(e)
+        progress['completed'] += 1
+        print(f"[{progress['completed']}/{progress['total']}] {message}")
+        if progress['completed'] % 500 == 0:
+            elapsed = time.perf_counter() - progress['started']
+            print(f"  Throughput: {format_throughput(progress['downloaded'], progress['bytes'], elapsed)}")
+
+async def _run(groups, concurrency, per_host):
+    work = asyncio.Queue()
+    for group in groups:
+        work.put_nowait(group)
+    progress = {'total': len(groups), 'completed': 0, 'downloaded': 0, 'bytes': 0, 'started': time.perf_counter()}
+
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=per_host)
+    timeout = aiohttp.ClientTimeout(total=120, sock_connect=30)
+    writer = BatchWriter(SessionLocal)
+    try:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            workers = [
+                asyncio.create_task(_worker(session, work, writer, progress))
+                for _ in range(min(concurrency, len(groups)))
+            ]
+            await asyncio.gather(*workers)
+    finally:
+        await asyncio.to_thread(writer.close)
+    return progress
+
+def download_images_async(groups, concurrency=ASYNC_DOWNLOAD_CONCURRENCY, per_host=ASYNC_PER_HOST_LIMIT):
+    """
+    Download [(img_ids, original_url, resolved_url), ...] with the asyncio engine.
+    Returns (images downloaded, bytes, seconds).
+    """
+    print(f"Async engine: {concurrency} transfers in flight, {per_host} per host.")
+    progress = asyncio.run(_run(groups, concurrency, per_host))
+    return progress['downloaded'], progress['bytes'], time.perf_counter() - progress['started']
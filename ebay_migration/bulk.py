@@ -0,0 +1,202 @@
+import io
+import json
+from sqlalchemy import insert, update, select, text, JSON, table, column
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from db import Listing, ListingImage, ListingStage
+from stages import new_stage_rows
+
+# Rows per statement. SQLite allows 32766 bound parameters per statement
+# and a listing row binds ~20, so stay well below that.
+UPSERT_CHUNK_SIZE = 500
+
+# Columns refreshed when an existing listing is re-extracted.
+# Identity (sku, category, policies) and migration state keep their first-extracted values.
+LISTING_UPDATE_COLUMNS = [
+    'title', 'description', 'quantity', 'price',
+    'condition_id', 'condition_description',
+    'item_specifics_json', 'product_identifiers_json', 'variations_json', 'best_offer_json',
+    'raw_listing_json', 'raw_archive_ref', 'content_hash',
+]
+
+# On PostgreSQL, batches at least this big are loaded with COPY through a temp
+# table; below it a multi-row INSERT is cheaper than the extra statements.
+PG_COPY_MIN_ROWS = 50
+
+def _chunks(seq, size):
+    for start in range(0, len(seq), size):
+        yield seq[start:start + size]
+
+def load_listing_index(db: Session, item_ids):
+    """Preload {item_id: (listing_id, content_hash)} for the given source item IDs."""
+    index = {}
+    item_ids = list(item_ids)
+    for chunk in _chunks(item_ids, UPSERT_CHUNK_SIZE):
+        rows = db.execute(
+            select(Listing.item_id, Listing.id, Listing.content_hash).where(Listing.item_id.in_(chunk))
+        )
+        for item_id, listing_id, content_hash in rows:
+            index[item_id] = (listing_id, content_hash)
+    return index
+
+def _upsert_statement(dialect_name):
+    """INSERT ... ON CONFLICT(item_id) DO UPDATE, or None if the dialect has no upsert."""
+    if dialect_name == 'sqlite':
+        stmt = sqlite.insert(Listing.__table__)
+    elif dialect_name == 'postgresql':
+        stmt = postgresql.insert(Listing.__table__)
+    else:
+        return None
+    return stmt.on_conflict_do_update(
+        index_elements=['item_id'],
+        set_={col: stmt.excluded[col] for col in LISTING_UPDATE_COLUMNS}
+    )
+
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def _copy_value(col, value):
+    """One field in COPY text format: \\N is NULL, so None and '' stay distinct."""
+    if isinstance(col.type, JSON) and not (value is None and col.type.none_as_null):
+        value = json.dumps(value) # None -> JSON null, like the ORM stores for these columns
+    if value is None:
+        return '\\N'
+    return str(value).translate(_COPY_ESCAPES)
+
+def _copy_data(model_table, columns, rows):
+    """Tab-separated rows for COPY ... FROM STDIN (text format)."""
+    cols = [model_table.c[name] for name in columns]
+    return ''.join(
+        '\t'.join(_copy_value(col, row.get(col.name)) for col in cols) + '\n'
+        for row in rows
+    )
+
+def _copy_rows(db: Session, target, model_table, columns, rows):
+    """
+    COPY rows into target over the session's own connection (same transaction).
+    Returns False if the DB driver has no COPY support.
+    """
+    sql = f"COPY {target} ({', '.join(columns)}) FROM STDIN"
+    data = _copy_data(model_table, columns, rows)
+    cursor = db.connection().connection.driver_connection.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'): # psycopg2
+            cursor.copy_expert(sql, io.StringIO(data))
+        elif hasattr(cursor, 'copy'): # psycopg 3
+            with cursor.copy(sql) as copy:
+                copy.write(data)
+        else:
+            return False
+    finally:
+        cursor.close()
+    return True
+
+def _copy_upsert_listings(db: Session, rows):
+    """
+    PostgreSQL bulk load: COPY the rows into a temp table, then one
+    INSERT ... SELECT ... ON CONFLICT(item_id) DO UPDATE into listings.
+    Returns False (nothing written) if the driver can't COPY.
+    """
+    listings = Listing.__table__
+    columns = [c.name for c in listings.columns if any(c.name in row for row in rows)]
+    db.execute(text("DROP TABLE IF EXISTS pg_temp.listings_stage"))
+    db.execute(text(
+        f"CREATE TEMP TABLE listings_stage ON COMMIT DROP AS "
+        f"SELECT {', '.join(columns)} FROM listings WITH NO DATA"
+    ))
+    if not _copy_rows(db, 'listings_stage', listings, columns, rows):
+        return False
+
+    stage = table('listings_stage', *[column(c) for c in columns])
+    stmt = postgresql.insert(listings).from_select(columns, select(stage))
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=['item_id'],
+        set_={col: stmt.excluded[col] for col in LISTING_UPDATE_COLUMNS if col in columns}
+    ))
+    return True
+
+def upsert_listings(db: Session, rows, image_urls, archive=None):
+    """
+    Insert or update many listings at once.
+
+    rows: list of Listing column dicts (must include item_id and content_hash).
+    image_urls: {item_id: [url, ...]} - images are only created for NEW listings,
+    matching the one-time image capture of the original per-row path.
+    archive: optional RawArchive. The raw_listing_json of new/changed rows is
+    appended there and only the pointer is stored on the row.
+
+    Returns {'new': [...], 'updated': [...], 'unchanged': [...]} lists of item_ids.
+    Does not commit.
+    """
+    result = {'new': [], 'updated': [], 'unchanged': []}
+
+    # Last occurrence wins if an item appears twice (Postgres rejects
+    # ON CONFLICT touching the same row twice in one statement).
+    by_item = {}
+    for row in rows:
+        by_item[row['item_id']] = row
+
+    existing = load_listing_index(db, by_item.keys())
+
+    changed = []
+    for item_id, row in by_item.items():
+        if item_id in existing:
+            if existing[item_id][1] == row['content_hash']:
+                result['unchanged'].append(item_id)
+                continue
+            result['updated'].append(item_id)
+        else:
+            result['new'].append(item_id)
+        changed.append(row)
+
+    if not changed:
+        return result
+
+    if archive is not None:
+        for row in changed:
+            row['raw_archive_ref'] = archive.append(row['item_id'], row['raw_listing_json'])
+            row['raw_listing_json'] = None
+        archive.flush()
+
+    dialect_name = db.get_bind().dialect.name
+    use_copy = (dialect_name == 'postgresql' and len(changed) >= PG_COPY_MIN_ROWS
+                and _copy_upsert_listings(db, changed))
+    if not use_copy:
+        upsert = _upsert_statement(dialect_name)
+        if upsert is not None:
+            for chunk in _chunks(changed, UPSERT_CHUNK_SIZE):
+                db.execute(upsert, chunk)
+        else:
+            # Generic fallback: plain bulk INSERT for new rows, executemany UPDATE for the rest
+            new_rows = [r for r in changed if r['item_id'] not in existing]
+            for chunk in _chunks(new_rows, UPSERT_CHUNK_SIZE):
+                db.execute(insert(Listing), chunk)
+            updates = [
+                {'id': existing[r['item_id']][0], **{c: r.get(c) for c in LISTING_UPDATE_COLUMNS}}
+                for r in changed if r['item_id'] in existing
+            ]
+            for chunk in _chunks(updates, UPSERT_CHUNK_SIZE):
+                db.execute(update(Listing), chunk)
+
+    # Images and stage rows for new listings need their generated IDs
+    if result['new']:
+        new_ids = load_listing_index(db, result['new'])
+        image_rows = []
+        for item_id in result['new']:
+            for rank, url in enumerate(image_urls.get(item_id, [])):
+                image_rows.append({
+                    'listing_id': new_ids[item_id][0],
+                    'original_url': url,
+                    'rank': rank
+                })
+        if not (use_copy and _copy_rows(db, 'listing_images', ListingImage.__table__,
+                                        ['listing_id', 'original_url', 'rank'], image_rows)):
+            for chunk in _chunks(image_rows, UPSERT_CHUNK_SIZE):
+                db.execute(insert(ListingImage), chunk)
+
+        stage_rows = new_stage_rows(new_ids[item_id][0] for item_id in result['new'])
+        if not (use_copy and _copy_rows(db, 'listing_stages', ListingStage.__table__,
+                                        list(stage_rows[0]), stage_rows)):
+            for chunk in _chunks(stage_rows, UPSERT_CHUNK_SIZE):
+                db.execute(insert(ListingStage), chunk)
+
+    return result
@@ -0,0 +1,70 @@
+"""
+Work claims for running several workers against one PostgreSQL database.
+
+A worker claims a batch of listings by stamping claimed_by/claimed_at. The
+candidate rows are picked with SELECT ... FOR UPDATE SKIP LOCKED, so two
+workers claiming at the same moment get disjoint batches instead of waiting
+on each other. Claims are released when the worker finishes; a worker that
+dies leaves them behind until CLAIM_LEASE_MINUTES have passed. A long batch
+renews each claim (renew_claim) right before working on that listing, and
+skips it if the lease ran out and another worker took it over.
+
+On SQLite FOR UPDATE is not rendered; its single writer already serialises claims.
+"""
+import datetime
+import os
+import socket
+from sqlalchemy import or_, select, update
+from sqlalchemy.orm import Session
+from db import Listing
+
+WORKER_ID = os.getenv("EBAY_WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+CLAIM_LEASE_MINUTES = int(os.getenv("EBAY_CLAIM_LEASE_MINUTES", 30))
+
+def claim_listings(db: Session, criteria, limit=None, worker_id=WORKER_ID, lease_minutes=CLAIM_LEASE_MINUTES):
+    """
+    Claim up to limit listings matching criteria (a list of filter expressions)
+    that no other worker holds. Commits. Returns the claimed listing IDs in ID order.
+    """
+    now = datetime.datetime.utcnow()
+    free = or_(
+        Listing.claimed_at == None,
+        Listing.claimed_at < now - datetime.timedelta(minutes=lease_minutes),
+        Listing.claimed_by == worker_id
+    )
+    candidates = select(Listing.id).where(*criteria, free).order_by(Listing.id).limit(limit) \
+        .with_for_update(skip_locked=True)
+    db.execute(
+        update(Listing).where(Listing.id.in_(candidates.scalar_subquery()))
+        .values(claimed_by=worker_id, claimed_at=now),
+        execution_options={'synchronize_session': False}
+    )
+    db.commit()
+    return list(db.scalars(
+        select(Listing.id).where(Listing.claimed_by == worker_id, Listing.claimed_at == now).order_by(Listing.id)
+    ))
+
+def renew_claim(db: Session, listing_id, criteria=(), worker_id=WORKER_ID):
+    """
+    Re-stamp this worker's claim on listing_id, if it still holds it and the
+    listing still matches criteria. Commits. Returns False when the claim was
+    lost (expired and taken by another worker) or the listing no longer qualifies.
+    """
+    result = db.execute(
+        update(Listing).where(Listing.id == listing_id, Listing.claimed_by == worker_id, *criteria)
+        .values(claimed_at=datetime.datetime.utcnow()),
+        execution_options={'synchronize_session': False}
+    )
+    db.commit()
+    return result.rowcount == 1
+
+def release_claims(db: Session, listing_ids, worker_id=WORKER_ID):
+    """Drop this worker's claims on listing_ids. Commits."""
+    listing_ids = list(listing_ids)
+    for start in range(0, len(listing_ids), 500):
+        db.execute(
+            update(Listing).where(Listing.id.in_(listing_ids[start:start + 500]), Listing.claimed_by == worker_id)
+            .values(claimed_by=None, claimed_at=None),
+            execution_options={'synchronize_session': False}
+        )
+    db.commit()
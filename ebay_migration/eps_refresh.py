@@ -0,0 +1,75 @@
+"""
+Re-upload EPS pictures that are about to expire.
+
+Pictures uploaded with UploadSiteHostedPictures are dropped by eBay after
+EPS_EXTENSION_DAYS unless a listing uses them. If publishing stalls, images of
+listings that are not migrated yet would go dead. This refreshes only those
+images instead of wiping every upload with scripts/reset_images.py.
+"""
+import concurrent.futures
+import datetime
+import os
+from functools import partial
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+from db import Listing, ListingImage, SessionLocal
+from upload_images import (
+    UPLOAD_WORKERS, EPS_REFRESH_MARGIN_DAYS, upload_single_image, content_key
+)
+from writer import BatchWriter
+from image_pipeline import stream_images_to_eps
+
+def find_expiring_images(db: Session, margin_days=EPS_REFRESH_MARGIN_DAYS, include_unknown=False):
+    """
+    Uploaded images of unmigrated listings that expire within margin_days.
+    include_unknown also returns images uploaded before expiry was recorded.
+    """
+    cutoff = datetime.datetime.utcnow() + datetime.timedelta(days=margin_days)
+    expiring = ListingImage.eps_expires_at < cutoff
+    if include_unknown:
+        expiring = or_(expiring, ListingImage.eps_expires_at == None)
+    return db.query(ListingImage).join(Listing).filter(
+        Listing.migrated == False,
+        ListingImage.new_eps_url != None,
+        expiring
+    ).all()
+
+def refresh_expiring_images(db: Session, oauth_token, margin_days=EPS_REFRESH_MARGIN_DAYS,
+                            include_unknown=False, max_workers=UPLOAD_WORKERS):
+    """
+    Re-upload expiring images. Images with a local file are uploaded from disk.
+    Streamed ones (no local copy) are fetched from the source again.
+    The old URL stays in place until its replacement is stored.
+    """
+    images = find_expiring_images(db, margin_days, include_unknown)
+    if not images:
+        print(f"No EPS images of unpublished listings expire within {margin_days} days.")
+        return
+
+    from_disk = {}
+    local_paths = {}
+    from_source = {}
+    for img in images:
+        if img.local_path and os.path.exists(img.local_path):
+            from_disk.setdefault(content_key(img), []).append(img.id)
+            local_paths.setdefault(content_key(img), img.local_path)
+        else:
+            from_source.setdefault(img.original_url, ([], img.resolved_url))[0].append(img.id)
+
+    print(f"{len(images)} EPS images expire within {margin_days} days: "
+          f"{len(from_disk)} files to re-upload, {len(from_source)} to re-fetch from source.")
+
+    if from_disk:
+        with BatchWriter(SessionLocal) as writer, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            worker = partial(upload_single_image, oauth_token=oauth_token, writer=writer)
+            futures = [executor.submit(worker, ids, local_paths[key]) for key, ids in from_disk.items()]
+            for completed, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                print(f"[{completed}/{len(futures)}] {future.result()}")
+
+    if from_source:
+        stream_images_to_eps(db, oauth_token, by_url=from_source)
+
+    db.expire_all()
+    remaining = len(find_expiring_images(db, margin_days, include_unknown))
+    print(f"Refresh finished. {remaining} images still expiring (failed uploads).")
@@ -0,0 +1,130 @@
+"""
+Size cap for the local image store (data/images).
+
+Once a blob's EPS upload is confirmed (every image using it has a new_eps_url)
+the local copy is only a cache. When EBAY_IMAGE_CACHE_MAX_MB is set, the least
+recently used of those blobs (file mtime, see images.touch_blob) are deleted until the store fits, and their rows
+drop local_path (content_sha256/phash stay). Blobs still waiting for upload are
+never evicted. If an evicted image is needed again (EPS refresh), it is fetched
+from the source.
+"""
+import os
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+from db import ListingImage
+from images import IMAGE_DIR, TMP_DIR
+from image_transform import UPLOAD_TMP_DIR
+from listings import get_sync_state, set_sync_state
+
+IMAGE_CACHE_MAX_MB = int(os.getenv("EBAY_IMAGE_CACHE_MAX_MB", 0)) # 0 = no limit
+
+EVICTED_FILES_KEY = 'image_cache_evicted_files'
+EVICTED_BYTES_KEY = 'image_cache_evicted_bytes'
+
+_SKIP_DIRS = {os.path.normpath(TMP_DIR), os.path.normpath(UPLOAD_TMP_DIR)}
+_UPDATE_CHUNK_SIZE = 500
+
+def _cached_files():
+    """(path, size, mtime) for every image file in the store, skipping temp dirs."""
+    for root, dirs, files in os.walk(IMAGE_DIR):
+        dirs[:] = [d for d in dirs if os.path.normpath(os.path.join(root, d)) not in _SKIP_DIRS]
+        for name in files:
+            path = os.path.normpath(os.path.join(root, name))
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            yield path, st.st_size, st.st_mtime
+
+def _upload_states(db: Session):
+    """
+    {file path: True if every image using it is on EPS, False if any is pending},
+    and {file path: local_path values as stored on the rows}.
+    """
+    states = {}
+    stored = {}
+    for local_path, eps_url in db.query(ListingImage.local_path, ListingImage.new_eps_url).filter(
+        ListingImage.local_path != None
+    ):
+        path = os.path.normpath(local_path)
+        states[path] = states.get(path, True) and eps_url is not None
+        stored.setdefault(path, set()).add(local_path)
+    return states, stored
+
+def cache_stats(db: Session):
+    """Current usage of the image store, split by upload state, plus lifetime evictions."""
+    states, _ = _upload_states(db)
+    stats = {
+        'files': 0, 'bytes': 0,
+        'pending_files': 0, 'pending_bytes': 0,
+        'uploaded_files': 0, 'uploaded_bytes': 0,
+        'orphan_files': 0, 'orphan_bytes': 0,
+        'max_bytes': IMAGE_CACHE_MAX_MB * 1024 * 1024,
+        'evicted_files': int(get_sync_state(db, EVICTED_FILES_KEY) or 0),
+        'evicted_bytes': int(get_sync_state(db, EVICTED_BYTES_KEY) or 0),
+    }
+    for path, size, _ in _cached_files():
+        state = states.get(path)
+        bucket = 'orphan' if state is None else ('uploaded' if state else 'pending')
+        stats['files'] += 1
+        stats['bytes'] += size
+        stats[f'{bucket}_files'] += 1
+        stats[f'{bucket}_bytes'] += size
+    return stats
+
+def print_cache_stats(stats):
+    mb = lambda n: n / (1024 * 1024)
+    limit = f"{mb(stats['max_bytes']):.0f} MB" if stats['max_bytes'] else "no limit"
+    print(f"Image cache: {stats['files']} files, {mb(stats['bytes']):.1f} MB ({limit})")
+    print(f"  Pending upload: {stats['pending_files']} files, {mb(stats['pending_bytes']):.1f} MB (never evicted)")
+    print(f"  Uploaded:       {stats['uploaded_files']} files, {mb(stats['uploaded_bytes']):.1f} MB (evictable)")
+    print(f"  Unreferenced:   {stats['orphan_files']} files, {mb(stats['orphan_bytes']):.1f} MB (evictable)")
+    print(f"  Evicted so far: {stats['evicted_files']} files, {mb(stats['evicted_bytes']):.1f} MB")
+
+def enforce_cache_limit(db: Session, max_bytes=IMAGE_CACHE_MAX_MB * 1024 * 1024):
+    """
+    Evict uploaded/unreferenced blobs, least recently used first, until the store
+    fits in max_bytes. Returns (files evicted, bytes freed).
+    """
+    if not max_bytes:
+        return 0, 0
+
+    files = list(_cached_files())
+    total = sum(size for _, size, _ in files)
+    if total <= max_bytes:
+        return 0, 0
+
+    states, stored = _upload_states(db)
+    evictable = sorted(
+        (f for f in files if states.get(f[0]) is not False),
+        key=lambda f: f[2]
+    )
+    evicted = []
+    freed = 0
+    for path, size, _ in evictable:
+        if total - freed <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        evicted.append(path)
+        freed += size
+
+    row_paths = [raw for path in evicted for raw in stored.get(path, ())]
+    for start in range(0, len(row_paths), _UPDATE_CHUNK_SIZE):
+        chunk = row_paths[start:start + _UPDATE_CHUNK_SIZE]
+        db.execute(
+            update(ListingImage).where(ListingImage.local_path.in_(chunk)).values(local_path=None),
+            execution_options={'synchronize_session': False}
+        )
+    set_sync_state(db, EVICTED_FILES_KEY, str(int(get_sync_state(db, EVICTED_FILES_KEY) or 0) + len(evicted)))
+    set_sync_state(db, EVICTED_BYTES_KEY, str(int(get_sync_state(db, EVICTED_BYTES_KEY) or 0) + freed))
+    db.commit()
+
+    mb = lambda n: n / (1024 * 1024)
+    print(f"Image cache: evicted {len(evicted)} uploaded files ({mb(freed):.1f} MB).")
+    if total - freed > max_bytes:
+        print(f"  Still {mb(total - freed):.1f} MB over a {mb(max_bytes):.0f} MB limit: "
+              f"the rest is waiting for EPS upload (run Step 4).")
+    return len(evicted), freed
@@ -0,0 +1,148 @@
+import concurrent.futures
+import hashlib
+import io
+import os
+import queue
+import threading
+import time
+from sqlalchemy.orm import Session
+from db import SessionLocal
+from images import (
+    DOWNLOAD_WORKERS, DOWNLOAD_CHUNK_SIZE, get_http_session,
+    url_extension, format_throughput, download_url_for, probe_image_urls, pending_downloads
+)
+from upload_images import UPLOAD_WORKERS, thread_upload_api, upload_picture, eps_url_rows
+from writer import BatchWriter
+from image_transform import transform_enabled, shrink_image_bytes, create_transform_pool
+
+# Images held in memory between the download and upload stages
+PIPELINE_BUFFER_IMAGES = int(os.getenv("EBAY_PIPELINE_BUFFER_IMAGES", 32))
+PIPELINE_UPLOAD_WORKERS = int(os.getenv("EBAY_PIPELINE_UPLOAD_WORKERS", UPLOAD_WORKERS))
+
+_DONE = object()
+
+def _download_to_memory(img_ids, original_url, resolved_url=None):
+    """Fetch one source image into memory. Returns (img_ids, filename, bytes, sha256)."""
+    download_url = download_url_for(original_url, resolved_url)
+    with get_http_session().get(download_url, stream=True, timeout=60) as r:
+        if r.status_code != 200:
+            raise RuntimeError(f"Failed {r.status_code}: {download_url}")
+        buf = io.BytesIO()
+        for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+            buf.write(chunk)
+    data = buf.getvalue()
+    filename = f"{img_ids[0]}.{url_extension(original_url)}"
+    return img_ids, filename, data, hashlib.sha256(data).hexdigest()
+
+def stream_images_to_eps(db: Session, oauth_token,
+                         download_workers=DOWNLOAD_WORKERS,
+                         upload_workers=PIPELINE_UPLOAD_WORKERS,
+                         buffer_images=PIPELINE_BUFFER_IMAGES, by_url=None):
+    """
+    Steps 2 + 4 in one pass: each source image is downloaded into memory and
+    handed straight to an EPS upload worker, without touching data/images.
+    Download and upload overlap, so the run takes roughly as long as the slower
+    of the two. A bounded queue caps how many images sit in memory.
+    Images that are already downloaded locally are left to Step 4.
+    When Pillow is installed, images are shrunk in a process pool before upload.
+    by_url: optional {original_url: ([image ids], resolved_url)} to stream instead
+    of every image that has neither a local file nor an EPS URL.
+    """
+    if by_url is None:
+        probe_image_urls(db)
+        by_url = pending_downloads(db)
+    pending = [iid for ids, _ in by_url.values() for iid in ids]
+
+    total = len(by_url)
+    if total == 0:
+        print("No images to stream.")
+        return
+
+    print(f"Found {len(pending)} images ({total} unique URLs). Streaming with "
+          f"{download_workers} download / {upload_workers} upload threads, buffer {buffer_images} images...")
+
+    handoff = queue.Queue(maxsize=buffer_images)
+    uploaded_by_sha = {} # Identical bytes from different URLs share one EPS upload
+    lock = threading.Lock()
+    stats = {'downloaded': 0, 'bytes': 0, 'uploaded': 0, 'reused': 0, 'failed': 0, 'upload_bytes': 0}
+    transform_pool = create_transform_pool() if transform_enabled() else None
+    writer = BatchWriter(SessionLocal)
+    started = time.perf_counter()
+
+    def report(message):
+        with lock:
+            done = stats['uploaded'] + stats['reused'] + stats['failed']
+        print(f"[{done}/{total}] {message}")
+
+    def upload_worker():
+        while True:
+            entry = handoff.get()
+            if entry is _DONE:
+                return
+            img_ids, filename, data, sha256 = entry
+            try:
+                with lock:
+                    full_url, expires_at = uploaded_by_sha.get(sha256, (None, None))
+                if full_url:
+                    with lock:
+                        stats['reused'] += 1
+                else:
+                    if transform_pool:
+                        data, ext = transform_pool.submit(shrink_image_bytes, data).result()
+                        if ext:
+                            filename = f"{filename.rsplit('.', 1)[0]}.{ext}"
+                    with lock:
+                        stats['upload_bytes'] += len(data)
+                    full_url, expires_at = upload_picture(thread_upload_api(oauth_token), filename, io.BytesIO(data))
+                    if not full_url:
+                        raise RuntimeError(f"Failed (No URL): image {img_ids[0]}")
+                    with lock:
+                        uploaded_by_sha[sha256] = (full_url, expires_at)
+                        stats['uploaded'] += 1
+                rows = eps_url_rows(img_ids, full_url, expires_at)
+                for row in rows:
+                    row['content_sha256'] = sha256
+                writer.put(rows)
+                report(f"Success: {img_ids[0]} -> {full_url}")
+            except Exception as e:
+                with lock:
+                    stats['failed'] += 1
+                report(f"Error {img_ids[0]}: {e}")
+
+    def download_worker(img_ids, original_url, resolved_url):
+        try:
+            entry = _download_to_memory(img_ids, original_url, resolved_url)
+        except Exception as e:
+            with lock:
+                stats['failed'] += 1
+            report(f"Error {img_ids[0]}: {e}")
+            return
+        with lock:
+            stats['downloaded'] += 1
+            stats['bytes'] += len(entry[2])
+        handoff.put(entry) # Blocks while the upload side is behind
+
+    uploaders = [threading.Thread(target=upload_worker, daemon=True) for _ in range(upload_workers)]
+    for t in uploaders:
+        t.start()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=download_workers) as executor:
+            futures = [
+                executor.submit(download_worker, ids, url, resolved)
+                for url, (ids, resolved) in by_url.items()
+            ]
+            for future in futures:
+                future.result()
+    finally:
+        for _ in uploaders:
+            handoff.put(_DONE)
+        for t in uploaders:
+            t.join()
+        if transform_pool:
+            transform_pool.shutdown()
+        writer.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"Streaming finished: downloaded {format_throughput(stats['downloaded'], stats['bytes'], elapsed)}")
+    print(f"  {stats['uploaded']} uploaded ({stats['upload_bytes'] / 1e6:.1f} MB), "
+          f"{stats['reused']} reused identical uploads, {stats['failed']} failed.")
@@ -0,0 +1,106 @@
+"""
+Optional resize/recompress stage applied to images before they are uploaded to EPS.
+
+Source originals are often several megabytes, far above the 1600px ($_57) size
+eBay serves. Shrinking them first cuts upload bandwidth for Step 4. The work is
+CPU-bound, so it runs in a process pool next to the network threads.
+
+Needs Pillow (`pip install Pillow`). Without it, or with EBAY_UPLOAD_MAX_EDGE=0,
+images are uploaded unchanged. Originals in data/images are never modified.
+"""
+import concurrent.futures
+import hashlib
+import io
+import os
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+UPLOAD_TMP_DIR = "data/images/upload_tmp"
+
+UPLOAD_MAX_EDGE = int(os.getenv("EBAY_UPLOAD_MAX_EDGE", 1600))
+UPLOAD_QUALITY = int(os.getenv("EBAY_UPLOAD_QUALITY", 85))
+TRANSFORM_WORKERS = int(os.getenv("EBAY_TRANSFORM_WORKERS", os.cpu_count() or 2))
+
+# Formats that are re-encoded at UPLOAD_QUALITY. Others are only resized.
+_LOSSY_FORMATS = {'JPEG', 'WEBP'}
+_EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp', 'PNG': 'png', 'GIF': 'gif'}
+
+def transform_enabled(max_edge=UPLOAD_MAX_EDGE):
+    return Image is not None and max_edge > 0
+
+def shrink_image_bytes(data, max_edge=UPLOAD_MAX_EDGE, quality=UPLOAD_QUALITY):
+    """
+    Downscale to max_edge, recompress JPEG/WebP at quality and drop metadata.
+    Returns (bytes, extension), or (data, None) when the result would not be
+    smaller or the image can't be decoded.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as im:
+            fmt = im.format
+            if fmt not in _EXTENSIONS:
+                return data, None
+            oversized = max(im.size) > max_edge
+            if fmt not in _LOSSY_FORMATS and not oversized:
+                return data, None
+
+            # Bake the EXIF rotation into the pixels, since the EXIF block is dropped
+            out = ImageOps.exif_transpose(im)
+            if oversized:
+                out.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+            options = {}
+            if fmt in _LOSSY_FORMATS:
+                options['quality'] = quality
+                if fmt == 'JPEG':
+                    options['optimize'] = True
+                    options['progressive'] = True
+                    if out.mode not in ('RGB', 'L'):
+                        out = out.convert('RGB')
+            elif fmt == 'PNG':
+                options['optimize'] = True
+
+            buf = io.BytesIO()
+            # No exif=/icc_profile= arguments, so metadata is not carried over
+            out.save(buf, format=fmt, **options)
+    except Exception:
+        return data, None
+
+    shrunk = buf.getvalue()
+    if len(shrunk) >= len(data):
+        return data, None
+    return shrunk, _EXTENSIONS[fmt]
+
+def prepare_upload_file(local_path, max_edge=UPLOAD_MAX_EDGE, quality=UPLOAD_QUALITY):
+    """
+    Process-pool worker: write a shrunk copy of local_path to UPLOAD_TMP_DIR.
+    Returns (upload path, original bytes, upload bytes). The upload path is
+    local_path itself when shrinking doesn't help.
+    """
+    with open(local_path, 'rb') as f:
+        data = f.read()
+    shrunk, ext = shrink_image_bytes(data, max_edge, quality)
+    if ext is None:
+        return local_path, len(data), len(data)
+
+    os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+    name = hashlib.sha256(data).hexdigest()
+    upload_path = os.path.join(UPLOAD_TMP_DIR, f"{name}-{max_edge}-q{quality}.{ext}")
+    tmp_path = f"{upload_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(shrunk)
+    os.replace(tmp_path, upload_path)
+    return upload_path, len(data), len(shrunk)
+
+def discard_upload_file(upload_path, local_path):
+    """Remove a shrunk copy once it has been uploaded (never the original)."""
+    if upload_path != local_path:
+        try:
+            os.remove(upload_path)
+        except FileNotFoundError:
+            pass
+
+def create_transform_pool(max_workers=TRANSFORM_WORKERS):
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
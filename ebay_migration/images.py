@@ -1,90 +1,440 @@
 import os
 import requests
-from sqlalchemy.orm import Session, sessionmaker
-from db import init_db, Listing, ListingImage
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+from db import SessionLocal, ListingImage
+from writer import BatchWriter
 import concurrent.futures
+import hashlib
 import re
+import base64
+import threading
+import time
 
 IMAGE_DIR = "data/images"
+# Content-addressed store: data/images/blobs/ab/abcdef...<sha256>.jpg
+BLOB_DIR = os.path.join(IMAGE_DIR, "blobs")
+TMP_DIR = os.path.join(IMAGE_DIR, "tmp")
 
-# Create a scoped session factory for thread safety
-SessionLocal = sessionmaker(bind=init_db())
+DOWNLOAD_WORKERS = int(os.getenv("EBAY_DOWNLOAD_WORKERS", 8))
+# Concurrent HEAD/Range probes when resolving the best image size
+PROBE_WORKERS = int(os.getenv("EBAY_PROBE_WORKERS", 32))
+# 'threads' (ThreadPoolExecutor) or 'async' (asyncio engine in async_images.py)
+DOWNLOAD_MODE = os.getenv("EBAY_DOWNLOAD_MODE", "threads")
+# Read/write size for streamed downloads
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+WRITE_BUFFER_SIZE = 1024 * 1024
 
-def download_single_image(img_id):
+_thread_local = threading.local()
+
+class DownloadError(Exception):
+    pass
+
+def get_http_session():
+    """
+    Keep-alive session for the current worker thread, so repeated downloads from
+    i.ebayimg.com reuse one TCP+TLS connection instead of a new handshake each time.
+    """
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=2, max_retries=retries)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _thread_local.session = session
+    return session
+
+def high_res_url(url):
+    """HACK: Force High Resolution (s-l1600 or $_57)"""
+    download_url = url
+    if "i.ebayimg.com" in download_url:
+        # Modern format: s-l300 -> s-l1600
+        if re.search(r's-l\d+', download_url):
+            download_url = re.sub(r's-l\d+', 's-l1600', download_url)
+        # Legacy format: $_1.JPG -> $_57.JPG (Standard High Res)
+        elif re.search(r'\$_\d+\.(JPG|jpg|PNG|png)', download_url):
+             download_url = re.sub(r'\$_\d+', '$_57', download_url)
+    return download_url
+
+# i.ebayimg.com "s-lNNN" sizes tried when resolving, largest first
+MODERN_SIZES = [1600, 1200, 1000, 800, 640, 500]
+
+def candidate_urls(url):
+    """
+    Source URL variants to try, best first, ending with the URL as extracted.
+    Only sizes larger than the extracted one are worth probing.
     """
-    Worker function to download a single image.
-    Uses its own DB session to be thread-safe.
+    candidates = []
+    if "i.ebayimg.com" in url:
+        match = re.search(r's-l(\d+)', url)
+        if match:
+            current = int(match.group(1))
+            candidates = [re.sub(r's-l\d+', f's-l{size}', url) for size in MODERN_SIZES if size > current]
+        elif re.search(r'\$_\d+\.(JPG|jpg|PNG|png)', url):
+            candidates = [re.sub(r'\$_\d+', '$_57', url)]
+    candidates.append(url)
+    return list(dict.fromkeys(candidates))
+
+_GONE_STATUSES = (404, 410)
+
+def probe_url(session, url):
+    """
+    True if the source serves url, False if it definitively doesn't (404/410),
+    None if that couldn't be told (timeout, 429, 5xx...). HEAD first; servers
+    that don't answer HEAD get a one-byte Range GET so no image body is transferred.
     """
-    db = SessionLocal()
     try:
-        img = db.query(ListingImage).get(img_id)
-        if not img:
-            return f"Skipped (Img ID {img_id} not found)"
-            
-        listing = db.query(Listing).get(img.listing_id)
-        if not listing:
-            return f"Skipped (Listing ID {img.listing_id} not found)"
-            
-        sku_safe = "".join([c for c in listing.sku if c.isalnum() or c in ('-','_')])
-        
-        # Create folder for this listing
-        save_dir = os.path.join(IMAGE_DIR, sku_safe)
-        os.makedirs(save_dir, exist_ok=True)
-        
-        # Filename: rank.jpg (or original extension)
-        ext = 'jpg'
-        if '.' in img.original_url:
-            ext = img.original_url.split('.')[-1].split('?')[0]
-            
-        filename = f"{img.rank}.{ext}"
-        local_path = os.path.join(save_dir, filename)
-        
-        # HACK: Force High Resolution (s-l1600 or $_57)
-        download_url = img.original_url
-        if "i.ebayimg.com" in download_url:
-            # Modern format: s-l300 -> s-l1600
-            if re.search(r's-l\d+', download_url):
-                download_url = re.sub(r's-l\d+', 's-l1600', download_url)
-            # Legacy format: $_1.JPG -> $_57.JPG (Standard High Res)
-            elif re.search(r'\$_\d+\.(JPG|jpg|PNG|png)', download_url):
-                 download_url = re.sub(r'\$_\d+', '$_57', download_url)
-                
-        r = requests.get(download_url, stream=True)
+        r = session.head(url, allow_redirects=True, timeout=15)
         if r.status_code == 200:
-            with open(local_path, 'wb') as f:
-                for chunk in r.iter_content(1024):
+            return True
+        if r.status_code in _GONE_STATUSES:
+            return False
+        if r.status_code not in (403, 405, 501):
+            return None
+        with session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=15) as r:
+            if r.status_code in (200, 206):
+                return True
+            return False if r.status_code in _GONE_STATUSES else None
+    except requests.RequestException:
+        return None
+
+def resolve_image_url(original_url):
+    """
+    Largest available variant of original_url, '' if every variant is gone
+    (404/410), or None if a probe failed before any variant answered: the
+    image stays unprobed, to be retried, instead of being skipped for good.
+    """
+    session = get_http_session()
+    unknown = False
+    for url in candidate_urls(original_url):
+        served = probe_url(session, url)
+        if served:
+            return url
+        if served is None:
+            unknown = True
+    return None if unknown else ''
+
+def download_url_for(original_url, resolved_url):
+    """URL to transfer: the probed one when known, else the regex rewrite."""
+    return resolved_url or high_res_url(original_url)
+
+def probe_image_urls(db: Session, max_workers=PROBE_WORKERS):
+    """
+    Resolve the best available size for every pending source URL that has not
+    been probed yet, concurrently, and cache it in ListingImage.resolved_url.
+    """
+    pending = db.query(ListingImage.id, ListingImage.original_url).filter(
+        ListingImage.local_path == None,
+        ListingImage.new_eps_url == None,
+        ListingImage.resolved_url == None
+    ).all()
+    by_url = {}
+    for img_id, url in pending:
+        by_url.setdefault(url, []).append(img_id)
+    if not by_url:
+        return
+
+    print(f"Probing {len(by_url)} source URLs for the largest available size ({max_workers} threads)...")
+    missing = unknown = 0
+    with BatchWriter(SessionLocal) as writer, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        urls = list(by_url)
+        for url, resolved in zip(urls, executor.map(resolve_image_url, urls)):
+            if resolved is None:
+                # Left unprobed: downloads use the regex rewrite, the next run probes again
+                unknown += 1
+                continue
+            if not resolved:
+                missing += 1
+            writer.put([{'id': iid, 'resolved_url': resolved} for iid in by_url[url]])
+    if missing:
+        print(f"  {missing} images are not available at the source in any size; they will be skipped.")
+    if unknown:
+        print(f"  {unknown} source URLs could not be probed (errors); they will be probed again next run.")
+
+def url_extension(url):
+    """File extension from the URL (default jpg)."""
+    ext = 'jpg'
+    if '.' in url:
+        ext = url.split('.')[-1].split('?')[0]
+    return ext
+
+def blob_path(sha256, ext):
+    return os.path.join(BLOB_DIR, sha256[:2], f"{sha256}.{ext}")
+
+def touch_blob(path):
+    """Mark a blob as just used; the image cache evicts by file mtime (LRU)."""
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+def store_blob(tmp_path, sha256, ext):
+    """
+    Move a downloaded temp file into the content-addressed store.
+    If the same bytes are already stored, the temp file is discarded.
+    """
+    final_path = blob_path(sha256, ext)
+    if os.path.exists(final_path):
+        os.remove(tmp_path)
+        touch_blob(final_path)
+    else:
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(tmp_path, final_path)
+    return final_path
+
+def partial_path(original_url, download_url):
+    """
+    Stable temp path per pending download, so an interrupted one can be resumed.
+    Keyed on original_url like pending_downloads (two groups can resolve to the
+    same download URL and must not share a file), and on download_url so a
+    different resolved size is never resumed into it.
+    """
+    name = hashlib.sha1(f"{original_url}\n{download_url}".encode('utf-8')).hexdigest()
+    return os.path.join(TMP_DIR, f"{name}.part")
+
+def _validator_path(part):
+    return part + ".validator"
+
+def discard_partial(part):
+    for path in (part, _validator_path(part)):
+        if os.path.exists(path):
+            os.remove(path)
+
+def resume_headers(part):
+    """
+    Request headers to continue a partial download: Range from the bytes on disk,
+    and If-Range so a changed source image is sent in full instead of spliced.
+    Returns (offset, headers).
+    """
+    headers = {'Accept-Encoding': 'identity'} # Byte counts must match Content-Length
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset:
+        headers['Range'] = f"bytes={offset}-"
+        if os.path.exists(_validator_path(part)):
+            with open(_validator_path(part)) as f:
+                headers['If-Range'] = f.read().strip()
+    return offset, headers
+
+def content_range_total(headers):
+    """Total size from 'Content-Range: bytes a-b/total' (None if unknown)."""
+    total = (headers.get('Content-Range') or '').rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+def begin_partial(part, status, headers, offset):
+    """
+    Decide how to write a response into the partial file.
+    Returns (file mode, offset, expected total size or None).
+    """
+    if status == 206:
+        mode, expected_total = 'ab', content_range_total(headers)
+    elif status == 200:
+        # Full body: server ignored the Range, or the image changed (If-Range)
+        mode, offset = 'wb', 0
+        length = headers.get('Content-Length')
+        expected_total = int(length) if length and length.isdigit() else None
+    else:
+        raise DownloadError(f"Failed {status}")
+
+    validator = headers.get('ETag') or headers.get('Last-Modified')
+    if validator:
+        with open(_validator_path(part), 'w') as f:
+            f.write(validator)
+    return mode, offset, expected_total
+
+def hash_partial(part, offset):
+    """SHA-256 primed with the bytes already on disk (resumed downloads)."""
+    sha = hashlib.sha256()
+    if offset:
+        with open(part, 'rb') as f:
+            for chunk in iter(lambda: f.read(WRITE_BUFFER_SIZE), b''):
+                sha.update(chunk)
+    return sha
+
+def finish_partial(part, expected_total, status, headers, md5=None):
+    """
+    Integrity checks before the partial is promoted into the store.
+    A short file is kept so the next attempt resumes it; anything else bad is discarded.
+    """
+    size = os.path.getsize(part)
+    if expected_total is not None and size < expected_total:
+        raise DownloadError(f"Incomplete ({size}/{expected_total} bytes), will resume")
+    if expected_total is not None and size > expected_total:
+        discard_partial(part)
+        raise DownloadError(f"Size mismatch ({size}/{expected_total} bytes)")
+    content_md5 = headers.get('Content-MD5')
+    if status == 200 and content_md5 and md5 is not None:
+        if base64.b64encode(md5.digest()).decode() != content_md5:
+            discard_partial(part)
+            raise DownloadError("Checksum mismatch (Content-MD5)")
+    if os.path.exists(_validator_path(part)):
+        os.remove(_validator_path(part))
+
+def fetch_to_partial(session, download_url, part):
+    """
+    Download into the .part file (partial_path), resuming with an HTTP Range request when
+    an earlier attempt left one behind. The file is fsynced and verified against
+    Content-Length/Content-Range (and Content-MD5 when sent).
+    Returns (part path, sha256 hex, bytes transferred this time).
+    """
+    os.makedirs(TMP_DIR, exist_ok=True)
+    for _ in range(2):
+        offset, headers = resume_headers(part)
+        with session.get(download_url, headers=headers, stream=True, timeout=60) as r:
+            if r.status_code == 416:
+                # Nothing left to send: either the partial is already complete, or it is bogus
+                if content_range_total(r.headers) == offset:
+                    finish_partial(part, offset, 416, r.headers)
+                    return part, hash_partial(part, offset).hexdigest(), 0
+                discard_partial(part)
+                continue
+
+            mode, offset, expected_total = begin_partial(part, r.status_code, r.headers, offset)
+            sha = hash_partial(part, offset)
+            md5 = hashlib.md5() if r.status_code == 200 and r.headers.get('Content-MD5') else None
+            transferred = 0
+            with open(part, mode, buffering=WRITE_BUFFER_SIZE) as f:
+                for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
                     f.write(chunk)
-            
-            # Update DB
-            img.local_path = local_path
-            db.commit()
-            return f"Success: {local_path}"
-        else:
-            return f"Failed {r.status_code}: {download_url}"
+                    sha.update(chunk)
+                    if md5:
+                        md5.update(chunk)
+                    transferred += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+
+        finish_partial(part, expected_total, r.status_code, r.headers, md5)
+        return part, sha.hexdigest(), transferred
+    raise DownloadError("Range not satisfiable")
+
+def download_single_image(img_ids, original_url, writer, resolved_url=None):
+    """
+    Worker function to download one image URL.
+    img_ids are all ListingImage rows sharing that URL; they all get the same blob.
+    The file only reaches its final path (atomic rename) after it is verified,
+    and local_path is only set after that.
+    The worker never touches the DB: its result goes to the shared BatchWriter.
+    Returns (result message, bytes downloaded).
+    """
+    img_id = img_ids[0]
+    try:
+        ext = url_extension(original_url)
+        download_url = download_url_for(original_url, resolved_url)
+
+        try:
+            part, content_sha256, size = fetch_to_partial(get_http_session(), download_url, partial_path(original_url, download_url))
+        except DownloadError as e:
+            return f"{e}: {download_url}", 0
+        local_path = store_blob(part, content_sha256, ext)
+
+        # Update DB (every listing that uses this URL)
+        writer.put([
+            {'id': iid, 'local_path': local_path, 'content_sha256': content_sha256}
+            for iid in img_ids
+        ])
+        shared = f" (shared by {len(img_ids)} images)" if len(img_ids) > 1 else ""
+        return f"Success: {local_path}{shared}", size
 
     except Exception as e:
-        return f"Error {img_id}: {str(e)}"
-    finally:
-        db.close()
-
-def download_images(db: Session):
-    # Get all images that haven't been downloaded yet
-    # We just need IDs here to pass to workers
-    images = db.query(ListingImage).filter(ListingImage.local_path == None).all()
-    img_ids = [img.id for img in images]
-    
-    total = len(img_ids)
+        return f"Error {img_id}: {str(e)}", 0
+
+def reuse_downloaded_images(db: Session):
+    """
+    Point pending images at blobs already downloaded for the same URL.
+    Returns the number of images resolved without a download.
+    """
+    downloaded = {
+        url: (path, sha) for url, path, sha in db.query(
+            ListingImage.original_url, ListingImage.local_path, ListingImage.content_sha256
+        ).filter(ListingImage.local_path != None)
+        if os.path.exists(path)
+    }
+    reused = 0
+    for img in db.query(ListingImage).filter(ListingImage.local_path == None, ListingImage.new_eps_url == None):
+        if img.original_url in downloaded:
+            img.local_path, img.content_sha256 = downloaded[img.original_url]
+            reused += 1
+    db.commit()
+    return reused
+
+def format_throughput(count, nbytes, elapsed):
+    elapsed = max(elapsed, 1e-6)
+    mb = nbytes / (1024 * 1024)
+    return f"{count} images, {mb:.1f} MB in {elapsed:.1f}s ({count / elapsed:.1f} images/s, {mb / elapsed:.2f} MB/s)"
+
+def pending_downloads(db: Session):
+    """
+    {original_url: (image ids, resolved_url)} for images with neither a local file
+    nor an EPS URL, skipping those the probe found missing at the source.
+    """
+    pending = db.query(ListingImage.id, ListingImage.original_url, ListingImage.resolved_url).filter(
+        ListingImage.local_path == None,
+        ListingImage.new_eps_url == None,
+        or_(ListingImage.resolved_url == None, ListingImage.resolved_url != '')
+    ).all()
+    by_url = {}
+    for img_id, url, resolved in pending:
+        by_url.setdefault(url, ([], resolved))[0].append(img_id)
+    return by_url
+
+def download_images(db: Session, max_workers=DOWNLOAD_WORKERS, mode=DOWNLOAD_MODE):
+    # Make room first: evict already-uploaded blobs if the store is over its size cap
+    from image_cache import enforce_cache_limit
+    enforce_cache_limit(db)
+
+    reused = reuse_downloaded_images(db)
+    if reused:
+        print(f"Reused {reused} already-downloaded images (same source URL).")
+
+    probe_image_urls(db)
+
+    # Get all images that haven't been downloaded yet (streamed ones are already on EPS)
+    # We just need IDs here to pass to workers, grouped by URL so each is fetched once
+    by_url = pending_downloads(db)
+    pending = [iid for ids, _ in by_url.values() for iid in ids]
+
+    total = len(by_url)
     if total == 0:
         print("No images to download.")
         return
+
+    if mode == 'async':
+        try:
+            from async_images import download_images_async
+        except ImportError:
+            print("Async download mode needs aiohttp: pip install aiohttp")
+            return
+        print(f"Found {len(pending)} images ({total} unique URLs). Starting async download...")
+        downloaded, downloaded_bytes, elapsed = download_images_async(
+            [(ids, url, resolved) for url, (ids, resolved) in by_url.items()]
+        )
+        print(f"Download finished: {format_throughput(downloaded, downloaded_bytes, elapsed)}")
+        return
         
-    print(f"Found {total} images. Starting download with 8 threads...")
+    print(f"Found {len(pending)} images ({total} unique URLs). Starting download with {max_workers} threads...")
     
-    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-        futures = {executor.submit(download_single_image, iid): iid for iid in img_ids}
+    started = time.perf_counter()
+    downloaded = 0
+    downloaded_bytes = 0
+    with BatchWriter(SessionLocal) as writer, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(download_single_image, ids, url, writer, resolved): ids
+            for url, (ids, resolved) in by_url.items()
+        }
         
         completed = 0
         for future in concurrent.futures.as_completed(futures):
             completed += 1
-            result = future.result()
+            result, nbytes = future.result()
+            if nbytes:
+                downloaded += 1
+                downloaded_bytes += nbytes
             print(f"[{completed}/{total}] {result}")
+            if completed % 100 == 0:
+                print(f"  Throughput: {format_throughput(downloaded, downloaded_bytes, time.perf_counter() - started)}")
+
+    print(f"Download finished: {format_throughput(downloaded, downloaded_bytes, time.perf_counter() - started)}")
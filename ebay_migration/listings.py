@@ -1,9 +1,43 @@
 from ebaysdk.trading import Connection as Trading
 from ebaysdk.exception import ConnectionError
 from sqlalchemy.orm import Session
-from db import init_db, Listing, ListingImage
+from db import SyncState
+from bulk import upsert_listings
+from archive import get_archive
+import concurrent.futures
 import datetime
+import hashlib
+import json
 import os
+import queue
+import threading
+
+# Parallel GetItem calls while enriching a page. Each worker keeps its own connection.
+GETITEM_WORKERS = int(os.getenv("EBAY_GETITEM_WORKERS", 8))
+
+_thread_local = threading.local()
+
+# Incremental extraction watermark (SyncState key)
+LAST_EXTRACTION_KEY = 'last_extraction_at'
+# Checkpoint of an in-progress extraction (SyncState key, JSON)
+EXTRACTION_CURSOR_KEY = 'extraction_cursor'
+# Older checkpoints are discarded and extraction starts over
+RESUME_MAX_AGE = datetime.timedelta(days=2)
+# Re-read a little before the watermark so edits made during the previous run are not missed
+MOD_TIME_OVERLAP = datetime.timedelta(hours=1)
+# GetSellerList rejects time windows wider than 120 days
+MAX_MOD_TIME_WINDOW = datetime.timedelta(days=119)
+
+# Time-window sharding: split the window into N sub-windows fetched in parallel.
+# 1 = single sequential page walk.
+EXTRACT_SHARDS = int(os.getenv("EBAY_EXTRACT_SHARDS", 1))
+EXTRACT_SHARD_WORKERS = int(os.getenv("EBAY_EXTRACT_SHARD_WORKERS", 4))
+# A sub-window holding more listings than this is halved (until SHARD_MIN_SPAN)
+SHARD_MAX_ENTRIES = 5000
+SHARD_MIN_SPAN = datetime.timedelta(hours=1)
+
+# Fields that change without the listing itself changing (counters, countdowns)
+VOLATILE_ITEM_FIELDS = {'TimeLeft', 'HitCount', 'WatchCount', 'QuestionCount', 'Timestamp'}
 
 def create_trading_api(oauth_token):
     """Create a Trading API connection."""
@@ -16,6 +50,12 @@ def create_trading_api(oauth_token):
         siteid='0' # US
     )
 
+def compute_content_hash(item):
+    """SHA-256 over the item's data, ignoring volatile fields. Used to skip unchanged rows."""
+    stable = {k: v for k, v in item.items() if k not in VOLATILE_ITEM_FIELDS}
+    payload = json.dumps(stable, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
 def fetch_item_details(api, item_id):
     """
     Fetch full item details including ItemSpecifics using GetItem API.
@@ -32,51 +72,509 @@ def fetch_item_details(api, item_id):
         print(f"  Error fetching item {item_id}: {e}")
         return None
 
+# GetSellerList caps EntriesPerPage at 200 when DetailLevel=ReturnAll.
+SELLER_LIST_PAGE_SIZE = 200
+
+def format_ebay_time(dt):
+    """Format a datetime the way the Trading API expects (UTC, millisecond precision)."""
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+def end_time_filter(end_time_from, end_time_to):
+    """GetSellerList filter on listing end time."""
+    return {
+        'EndTimeFrom': format_ebay_time(end_time_from),
+        'EndTimeTo': format_ebay_time(end_time_to)
+    }
+
+def mod_time_filter(mod_time_from, mod_time_to):
+    """GetSellerList filter on last modification time (includes ended items)."""
+    return {
+        'ModTimeFrom': format_ebay_time(mod_time_from),
+        'ModTimeTo': format_ebay_time(mod_time_to)
+    }
+
+TIME_FILTERS = {
+    'end_time': end_time_filter,
+    'mod_time': mod_time_filter,
+}
+
+def active_listing_window():
+    """
+    Time window for GetSellerList: Active items.
+    Standard trick: EndTimeFrom = Now, EndTimeTo = Now + 120 days
+    """
+    now = datetime.datetime.utcnow()
+    return now, now + datetime.timedelta(days=120)
+
+def active_listing_filter():
+    return end_time_filter(*active_listing_window())
+
+def fetch_seller_list_page(api, page_number, time_filter):
+    """Fetch a single GetSellerList page. Raises ConnectionError on API failure."""
+    # ReturnAll is needed for Description and Specifics.
+    request = {
+        'DetailLevel': 'ReturnAll',
+        'IncludeItemSpecifics': 'true',  # CRITICAL: Include Book Title, Author, etc.
+        'Pagination': {
+            'EntriesPerPage': SELLER_LIST_PAGE_SIZE,
+            'PageNumber': page_number
+        }
+    }
+    request.update(time_filter)
+    response = api.execute('GetSellerList', request)
+    return response.dict()
+
+def _page_items(page):
+    """The page's item list (GetSellerList returns a dict for a single item)."""
+    items = page.get('ItemArray', {}) or {}
+    page_items = items.get('Item', [])
+    if not isinstance(page_items, list):
+        page_items = [page_items]
+    return page_items
+
+def _set_page_items(page, page_items):
+    if page.get('ItemArray'):
+        page['ItemArray']['Item'] = page_items
+
+def _last_item_id(page):
+    page_items = _page_items(page)
+    return page_items[-1].get('ItemID') if page_items else None
+
+def _skip_processed_items(page, last_item_id):
+    """
+    Resuming: the last checkpointed page is fetched again and only items after
+    the checkpointed ItemID are kept. This catches listings that shifted onto
+    that page (e.g. because earlier ones ended) without redoing the rest.
+    """
+    page_items = _page_items(page)
+    ids = [i.get('ItemID') for i in page_items]
+    if last_item_id in ids:
+        _set_page_items(page, page_items[ids.index(last_item_id) + 1:])
+
+def iter_seller_list_pages(oauth_token, time_filter=None, start_page=1, last_item_id=None):
+    """
+    Walk every GetSellerList page for the filter, yielding (page_number, total_pages, page).
+    The next page is fetched on a background thread while the caller processes
+    the current one, so at most two pages are held in memory at any time.
+
+    start_page/last_item_id resume from a checkpoint: start_page is re-read and
+    only items after last_item_id on it are yielded.
+    """
+    if time_filter is None:
+        time_filter = active_listing_filter()
+
+    # Dedicated connection: ebaysdk connections keep per-request state,
+    # so the prefetch thread must not share one with the GetItem calls.
+    api = create_trading_api(oauth_token)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        page_number = start_page
+        future = executor.submit(fetch_seller_list_page, api, page_number, time_filter)
+        while future is not None:
+            page = future.result()
+            pagination = page.get('PaginationResult', {})
+            total_pages = int(pagination.get('TotalNumberOfPages') or 1)
+
+            # Start fetching the next page before handing this one to the caller
+            future = None
+            if page_number < total_pages:
+                future = executor.submit(fetch_seller_list_page, api, page_number + 1, time_filter)
+
+            if page_number == start_page and last_item_id:
+                _skip_processed_items(page, last_item_id)
+            yield page_number, total_pages, page
+            page_number += 1
+
+def _thread_trading_api(oauth_token):
+    """Return this thread's Trading connection (ebaysdk connections are not thread-safe)."""
+    if getattr(_thread_local, 'token', None) != oauth_token:
+        _thread_local.api = create_trading_api(oauth_token)
+        _thread_local.token = oauth_token
+    return _thread_local.api
+
+def enrich_items(items, oauth_token, max_workers=GETITEM_WORKERS):
+    """
+    Replace each GetSellerList item with its full GetItem record using a bounded
+    thread pool. Yields items in input order so the caller can save them in order.
+    An item whose GetItem call fails is yielded with its GetSellerList data.
+    """
+    def worker(item):
+        item_id = item.get('ItemID')
+        try:
+            full_item = fetch_item_details(_thread_trading_api(oauth_token), item_id)
+        except Exception as e:
+            print(f"  Error fetching item {item_id}: {e}")
+            full_item = None
+        return full_item or item
+
+    total = len(items)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for idx, item in enumerate(executor.map(worker, items)):
+            if (idx + 1) % 10 == 0 or idx == 0:
+                print(f"  Fetching full details: {idx+1}/{total}...")
+            yield item
+
+def count_seller_list_entries(api, time_filter):
+    """Cheap probe: total listings in a window (1 entry per page, no details)."""
+    request = {
+        'GranularityLevel': 'Coarse',
+        'Pagination': {
+            'EntriesPerPage': 1,
+            'PageNumber': 1
+        }
+    }
+    request.update(time_filter)
+    response = api.execute('GetSellerList', request)
+    return int(response.dict().get('PaginationResult', {}).get('TotalNumberOfEntries') or 0)
+
+def split_window(start, end, parts):
+    """Split [start, end] into `parts` equal, contiguous sub-windows."""
+    step = (end - start) / parts
+    bounds = [start + step * i for i in range(parts)] + [end]
+    return [(bounds[i], bounds[i + 1]) for i in range(parts)]
+
+def plan_windows(oauth_token, window, make_filter, shards, max_workers=EXTRACT_SHARD_WORKERS):
+    """
+    Split the window into `shards` sub-windows, probe how many listings each holds,
+    and keep halving the dense ones (> SHARD_MAX_ENTRIES) so no single window
+    dominates the run. Empty windows are dropped.
+    Returns [((start, end), entries), ...] largest first, for better load balancing.
+    """
+    pending = split_window(window[0], window[1], shards)
+    planned = []
+
+    def probe(sub_window):
+        return count_seller_list_entries(_thread_trading_api(oauth_token), make_filter(*sub_window))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending:
+            counts = list(executor.map(probe, pending))
+            next_pending = []
+            for sub_window, entries in zip(pending, counts):
+                if entries == 0:
+                    continue
+                if entries > SHARD_MAX_ENTRIES and sub_window[1] - sub_window[0] > SHARD_MIN_SPAN:
+                    print(f"  Window {sub_window[0]:%Y-%m-%d %H:%M} - {sub_window[1]:%Y-%m-%d %H:%M} "
+                          f"has {entries} listings. Splitting.")
+                    next_pending.extend(split_window(sub_window[0], sub_window[1], 2))
+                else:
+                    planned.append((sub_window, entries))
+            pending = next_pending
+
+    planned.sort(key=lambda p: p[1], reverse=True)
+    return planned
+
+def _put_until_stopped(q, entry, stop):
+    """Blocking put that gives up once the consumer has gone away."""
+    while not stop.is_set():
+        try:
+            q.put(entry, timeout=0.5)
+            return
+        except queue.Full:
+            continue
+
+def _dedupe_page(page, seen_item_ids):
+    """Drop items already yielded from another window (window bounds are inclusive)."""
+    unique = []
+    for item in _page_items(page):
+        item_id = item.get('ItemID')
+        if item_id not in seen_item_ids:
+            seen_item_ids.add(item_id)
+            unique.append(item)
+    _set_page_items(page, unique)
+
+def iter_sharded_pages(oauth_token, planned, make_filter, max_workers=EXTRACT_SHARD_WORKERS, progress=None):
+    """
+    Walk planned sub-windows (see plan_windows) in parallel, yielding
+    (label, page, position) as pages arrive. position is the checkpoint for that
+    window: {'key', 'page', 'last_item_id'}.
+    Pages pass through a queue bounded by the worker count, so memory stays at a
+    few pages regardless of catalog size. Items are deduplicated by ItemID.
+
+    progress: {window_key: position} from a previous run; those windows resume
+    from their checkpointed page.
+    """
+    progress = progress or {}
+    pages = queue.Queue(maxsize=max_workers)
+    stop = threading.Event()
+    done = object()
+
+    def walk(index, sub_window):
+        key = str(index)
+        try:
+            api = _thread_trading_api(oauth_token)
+            time_filter = make_filter(*sub_window)
+            resume = progress.get(key, {})
+            page_number = resume.get('page', 1)
+            total_pages = page_number
+            while page_number <= total_pages and not stop.is_set():
+                page = fetch_seller_list_page(api, page_number, time_filter)
+                total_pages = int(page.get('PaginationResult', {}).get('TotalNumberOfPages') or 1)
+                position = {'key': key, 'page': page_number, 'last_item_id': _last_item_id(page)}
+                if resume.get('last_item_id') and page_number == resume.get('page'):
+                    _skip_processed_items(page, resume['last_item_id'])
+                label = f"Window {index + 1}/{len(planned)}, page {page_number}/{total_pages}"
+                _put_until_stopped(pages, (label, page, position), stop)
+                page_number += 1
+        except Exception as e:
+            _put_until_stopped(pages, (f"Window {index + 1}", e, None), stop)
+        finally:
+            _put_until_stopped(pages, done, stop)
+
+    seen_item_ids = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for index, (sub_window, _) in enumerate(planned):
+            executor.submit(walk, index, sub_window)
+        remaining = len(planned)
+        try:
+            while remaining:
+                entry = pages.get()
+                if entry is done:
+                    remaining -= 1
+                    continue
+                label, page, position = entry
+                if isinstance(page, Exception):
+                    raise page
+                _dedupe_page(page, seen_item_ids)
+                yield label, page, position
+        finally:
+            stop.set()
+
 def fetch_active_listings(ioauth_token):
     """
-    Fetch all active listings using Trading API GetSellerList.
+    Fetch the first page of active listings using Trading API GetSellerList.
     Using OAuth token (iaf_token).
+    Use extract_active_listings to walk every page.
     """
     api = create_trading_api(ioauth_token)
 
-    # Time window for GetSellerList: Active items.
-    # Standard trick: EndTimeFrom = Now, EndTimeTo = Now + 120 days
-    now = datetime.datetime.utcnow()
-    end_time_from = now
-    end_time_to = now + datetime.timedelta(days=120)
-
     try:
-        # Page 1 (assuming < 200 items as user said 181)
-        # GranularityLevel=Coarse or DetailLevel=ReturnAll? 
-        # ReturnAll is needed for Description and Specifics.
-        response = api.execute('GetSellerList', {
-            'DetailLevel': 'ReturnAll',
-            'IncludeItemSpecifics': 'true',  # CRITICAL: Include Book Title, Author, etc.
-            'EndTimeFrom': end_time_from.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
-            'EndTimeTo': end_time_to.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
-            'Pagination': {
-                'EntriesPerPage': 200,
-                'PageNumber': 1
-            }
-        })
-        
+        page = fetch_seller_list_page(api, 1, active_listing_filter())
         # Return both the response and the API object for individual item fetches
-        return response.dict(), api
+        return page, api
 
     except ConnectionError as e:
         print(f"Trading API Error: {e}")
         print(f"Response: {e.response.dict() if e.response else 'None'}")
         return None, None
 
-def parse_and_save_listings(db: Session, api_response, api=None):
+def get_sync_state(db: Session, key):
+    state = db.get(SyncState, key)
+    return state.value if state else None
+
+def set_sync_state(db: Session, key, value):
+    state = db.get(SyncState, key)
+    if not state:
+        state = SyncState(key=key)
+        db.add(state)
+    state.value = value
+    state.updated_at = datetime.datetime.utcnow()
+
+def get_last_extraction_time(db: Session):
+    value = get_sync_state(db, LAST_EXTRACTION_KEY)
+    return datetime.datetime.fromisoformat(value) if value else None
+
+def _drop_inactive_items(page):
+    """ModTime windows also return ended/sold items; keep only active ones."""
+    _set_page_items(page, [
+        i for i in _page_items(page)
+        if i.get('SellingStatus', {}).get('ListingStatus', 'Active') == 'Active'
+    ])
+
+def load_extraction_cursor(db: Session):
+    """Checkpoint of an interrupted extraction, or None."""
+    value = get_sync_state(db, EXTRACTION_CURSOR_KEY)
+    return json.loads(value) if value else None
+
+def _new_extraction_cursor(db: Session, oauth_token, incremental, shards):
+    started_at = datetime.datetime.utcnow()
+    window = active_listing_window()
+    filter_name = 'end_time'
+
+    if incremental:
+        last_run = get_last_extraction_time(db)
+        if last_run is None:
+            print("No previous extraction recorded. Running full extraction.")
+        elif started_at - last_run > MAX_MOD_TIME_WINDOW:
+            print(f"Last extraction ({last_run}) is too old for a ModTime window. Running full extraction.")
+        else:
+            print(f"Incremental extraction: listings modified since {last_run} (UTC)...")
+            window = (last_run - MOD_TIME_OVERLAP, started_at)
+            filter_name = 'mod_time'
+
+    planned = None
+    if shards > 1:
+        make_filter = TIME_FILTERS[filter_name]
+        planned = plan_windows(oauth_token, window, make_filter, shards)
+        total_entries = sum(entries for _, entries in planned)
+        print(f"Sharded extraction: {total_entries} listings in {len(planned)} windows, {EXTRACT_SHARD_WORKERS} workers.")
+
+    return {
+        'started_at': started_at.isoformat(),
+        'filter': filter_name,
+        'window': [window[0].isoformat(), window[1].isoformat()],
+        'planned': [[w[0].isoformat(), w[1].isoformat(), entries] for w, entries in planned] if planned is not None else None,
+        'progress': {}
+    }
+
+def extract_active_listings(db: Session, oauth_token, incremental=False, shards=EXTRACT_SHARDS):
+    """
+    Fetch ALL active listings page by page and save each page as it arrives.
+    Pages are pipelined: page N+1 downloads while page N is enriched and saved.
+
+    incremental=True only fetches listings modified since the last successful
+    extraction (GetSellerList ModTime window). Falls back to a full extraction
+    when no previous run is recorded or it is too old for a single window.
+
+    shards > 1 splits the time window into sub-windows fetched in parallel.
+
+    Each page is committed together with a cursor (page, window, last ItemID).
+    If a run dies, the next call resumes from that cursor with the original
+    settings instead of starting over.
+    """
+    try:
+        cursor = load_extraction_cursor(db)
+        if cursor and datetime.datetime.utcnow() - datetime.datetime.fromisoformat(cursor['started_at']) > RESUME_MAX_AGE:
+            print(f"Discarding stale checkpoint from {cursor['started_at']}.")
+            cursor = None
+
+        if cursor:
+            done_pages = sum(p['page'] for p in cursor['progress'].values())
+            print(f"Resuming interrupted extraction started {cursor['started_at']} (UTC), {done_pages} pages already saved.")
+        else:
+            cursor = _new_extraction_cursor(db, oauth_token, incremental, shards)
+
+        make_filter = TIME_FILTERS[cursor['filter']]
+        if cursor['planned'] is not None:
+            planned = [
+                ((datetime.datetime.fromisoformat(f), datetime.datetime.fromisoformat(t)), entries)
+                for f, t, entries in cursor['planned']
+            ]
+            pages = iter_sharded_pages(oauth_token, planned, make_filter, progress=cursor['progress'])
+        else:
+            window = [datetime.datetime.fromisoformat(v) for v in cursor['window']]
+            resume = cursor['progress'].get('all', {})
+            pages = (
+                (f"Page {page_number}/{total_pages}", page,
+                 {'key': 'all', 'page': page_number, 'last_item_id': _last_item_id(page) or resume.get('last_item_id')})
+                for page_number, total_pages, page in iter_seller_list_pages(
+                    oauth_token, make_filter(*window), resume.get('page', 1), resume.get('last_item_id'))
+            )
+
+        totals = {'new': 0, 'updated': 0, 'unchanged': 0}
+        for label, page, position in pages:
+            print(f"\n--- {label} ---")
+            if make_filter is mod_time_filter:
+                _drop_inactive_items(page)
+            cursor['progress'][position['key']] = {'page': position['page'], 'last_item_id': position['last_item_id']}
+            counts = parse_and_save_listings(db, page, oauth_token, checkpoint=cursor)
+            for key, value in counts.items():
+                totals[key] += value
+    except ConnectionError as e:
+        print(f"Trading API Error: {e}")
+        print(f"Response: {e.response.dict() if e.response else 'None'}")
+        print("Extraction stopped. Saved pages are kept; run Step 1 again to resume.")
+        return
+
+    # Only a completed run moves the incremental watermark forward
+    set_sync_state(db, LAST_EXTRACTION_KEY, cursor['started_at'])
+    set_sync_state(db, EXTRACTION_CURSOR_KEY, None)
+    db.commit()
+    print(f"Extraction complete: {totals['new']} new, {totals['updated']} updated, {totals['unchanged']} unchanged.")
+
+def listing_row(item, content_hash):
+    """Map a Trading API item to Listing column values."""
+    # Extract basic fields
+    item_id = item.get('ItemID')
+    sku = item.get('SKU', f"NOSKU_{item_id}") # Fallback if no SKU
+    title = item.get('Title')
+    subtitle = item.get('SubTitle')
+    description = item.get('Description')
+    price = item.get('SellingStatus', {}).get('CurrentPrice', {}).get('value')
+    qty = int(item.get('Quantity', 0)) - int(item.get('SellingStatus', {}).get('QuantitySold', 0))
+    cat_id = item.get('PrimaryCategory', {}).get('CategoryID')
+
+    # Policy IDs
+    seller_profiles = item.get('SellerProfiles', {})
+    pay_id = seller_profiles.get('SellerPaymentProfile', {}).get('PaymentProfileID')
+    ship_id = seller_profiles.get('SellerShippingProfile', {}).get('ShippingProfileID')
+    ret_id = seller_profiles.get('SellerReturnProfile', {}).get('ReturnProfileID')
+
+    # Condition
+    cond_id = item.get('ConditionID', '1000')
+    cond_desc = item.get('ConditionDescription')
+
+    # Item Specifics - SAVE AS LISTS (Inventory API REST format)
+    specifics = {}
+    if 'ItemSpecifics' in item and 'NameValueList' in item['ItemSpecifics']:
+         nv_list = item['ItemSpecifics']['NameValueList']
+         if not isinstance(nv_list, list): nv_list = [nv_list]
+         for nv in nv_list:
+             name = nv.get('Name')
+             val = nv.get('Value')
+             if not isinstance(val, list): val = [val]
+             specifics[name] = val
+
+    # Deep Dive: Product Identifiers (UPC, EAN, ISBN)
+    product_ids = {}
+    prod_listing_details = item.get('ProductListingDetails', {})
+    for key in ['UPC', 'EAN', 'ISBN', 'BrandMPN']:
+        if prod_listing_details.get(key):
+            product_ids[key] = prod_listing_details.get(key)
+
+    # Deep Dive: Variations
+    variations_data = None
+    if 'Variations' in item:
+        variations_data = item.get('Variations')
+
+    # Deep Dive: Best Offer
+    best_offer_data = item.get('BestOfferDetails')
+
+    return {
+        'item_id': item_id,
+        'sku': sku,
+        'title': title,
+        'subtitle': subtitle,
+        'description': description,
+        'quantity': qty,
+        'price': price,
+        'category_id': cat_id,
+        'payment_policy_id': pay_id,
+        'shipping_policy_id': ship_id,
+        'return_policy_id': ret_id,
+        'condition_id': cond_id,
+        'condition_description': cond_desc,
+        'item_specifics_json': specifics,
+        'product_identifiers_json': product_ids,
+        'variations_json': variations_data,
+        'best_offer_json': best_offer_data,
+        'raw_listing_json': item, # Full safety net (moved to the raw archive on save)
+        'raw_archive_ref': None,
+        'content_hash': content_hash,
+    }
+
+def picture_urls(item):
+    pic_details = item.get('PictureDetails', {})
+    urls = pic_details.get('PictureURL', [])
+    if isinstance(urls, str): urls = [urls]
+    return urls
+
+def parse_and_save_listings(db: Session, api_response, oauth_token=None, max_workers=GETITEM_WORKERS, checkpoint=None):
     """
     Parse listings and save to DB.
-    If api is provided, fetches full item details via GetItem for each listing
+    If oauth_token is provided, fetches full item details via GetItem for each listing
     to get complete ItemSpecifics (GetSellerList doesn't return them reliably).
+    GetItem calls run concurrently; items are still written in page order.
+    The page is persisted with one bulk upsert instead of a query + flush per item.
+    checkpoint (extraction cursor) is saved in the same commit as the page.
     """
-    if not api_response or 'ItemArray' not in api_response or 'Item' not in api_response['ItemArray']:
+    counts = {'new': 0, 'updated': 0, 'unchanged': 0}
+    if not api_response or not api_response.get('ItemArray') or not api_response['ItemArray'].get('Item'):
         print("No items found in response.")
-        return
+        if checkpoint is not None:
+            set_sync_state(db, EXTRACTION_CURSOR_KEY, json.dumps(checkpoint))
+            db.commit()
+        return counts
 
     items = api_response['ItemArray']['Item']
     if not isinstance(items, list):
@@ -84,123 +582,30 @@ def parse_and_save_listings(db: Session, api_response, api=None):
 
     print(f"Processing {len(items)} items...")
     
-    # If we have API access, fetch full details for each item
-    use_getitem = api is not None
-    if use_getitem:
-        print(f"(Fetching full item details for {len(items)} items including ItemSpecifics...)")
+    # If we have API access, get FULL item details via GetItem
+    if oauth_token:
+        print(f"(Fetching full item details for {len(items)} items including ItemSpecifics, {max_workers} workers...)")
+        items = enrich_items(items, oauth_token, max_workers)
 
-    for idx, item in enumerate(items):
-        item_id = item.get('ItemID')
-        
-        # If API available, get FULL item details via GetItem
-        if use_getitem:
-            if (idx + 1) % 10 == 0 or idx == 0:
-                print(f"  Fetching full details: {idx+1}/{len(items)}...")
-            full_item = fetch_item_details(api, item_id)
-            if full_item:
-                item = full_item  # Replace with full data
-                
-        # Extract basic fields
-        item_id = item.get('ItemID')
-        sku = item.get('SKU', f"NOSKU_{item_id}") # Fallback if no SKU
-        title = item.get('Title')
-        subtitle = item.get('SubTitle')
-        description = item.get('Description')
-        price = item.get('SellingStatus', {}).get('CurrentPrice', {}).get('value')
-        qty = int(item.get('Quantity', 0)) - int(item.get('SellingStatus', {}).get('QuantitySold', 0))
-        cat_id = item.get('PrimaryCategory', {}).get('CategoryID')
-        
-        # Policy IDs
-        seller_profiles = item.get('SellerProfiles', {})
-        pay_id = seller_profiles.get('SellerPaymentProfile', {}).get('PaymentProfileID')
-        ship_id = seller_profiles.get('SellerShippingProfile', {}).get('ShippingProfileID')
-        ret_id = seller_profiles.get('SellerReturnProfile', {}).get('ReturnProfileID')
-
-        # Condition
-        cond_id = item.get('ConditionID', '1000') 
-        cond_desc = item.get('ConditionDescription')
-
-        # Item Specifics - SAVE AS LISTS (Inventory API REST format)
-        specifics = {}
-        if 'ItemSpecifics' in item and 'NameValueList' in item['ItemSpecifics']:
-             nv_list = item['ItemSpecifics']['NameValueList']
-             if not isinstance(nv_list, list): nv_list = [nv_list]
-             for nv in nv_list:
-                 name = nv.get('Name')
-                 val = nv.get('Value')
-                 if not isinstance(val, list): val = [val]
-                 specifics[name] = val
-                 
-        # Deep Dive: Product Identifiers (UPC, EAN, ISBN)
-        product_ids = {}
-        prod_listing_details = item.get('ProductListingDetails', {})
-        for key in ['UPC', 'EAN', 'ISBN', 'BrandMPN']:
-            if prod_listing_details.get(key):
-                product_ids[key] = prod_listing_details.get(key)
-                
-        # Deep Dive: Variations
-        variations_data = None
-        if 'Variations' in item:
-            variations_data = item.get('Variations')
-            
-        # Deep Dive: Best Offer
-        best_offer_data = item.get('BestOfferDetails')
-
-        # Check existence - UPDATE if exists, INSERT if new
-        existing = db.query(Listing).filter_by(item_id=item_id).first()
-        if existing:
-            # UPDATE existing record with new data (especially item_specifics_json)
-            existing.item_specifics_json = specifics
-            existing.product_identifiers_json = product_ids
-            existing.variations_json = variations_data
-            existing.best_offer_json = best_offer_data
-            existing.raw_listing_json = item
-            # Update other fields that might have changed
-            existing.title = title
-            existing.description = description
-            existing.quantity = qty
-            existing.price = price
-            existing.condition_id = cond_id
-            existing.condition_description = cond_desc
-            listing = existing
-            print(f"  Updated: {sku}")
-        else:
-            listing = Listing(
-                item_id=item_id,
-                sku=sku,
-                title=title,
-                subtitle=subtitle,
-                description=description,
-                quantity=qty,
-                price=price,
-                category_id=cat_id,
-                payment_policy_id=pay_id,
-                shipping_policy_id=ship_id,
-                return_policy_id=ret_id,
-                condition_id=cond_id,
-                condition_description=cond_desc,
-                item_specifics_json=specifics,
-                product_identifiers_json=product_ids,
-                variations_json=variations_data,
-                best_offer_json=best_offer_data,
-                raw_listing_json=item # Full safety net
-            )
-            db.add(listing)
-            db.flush() # Get ID
-            print(f"  New: {sku}")
-            
-            # Images
-            pic_details = item.get('PictureDetails', {})
-            urls = pic_details.get('PictureURL', [])
-            if isinstance(urls, str): urls = [urls]
-            
-            for idx, url in enumerate(urls):
-                img = ListingImage(
-                    listing_id=listing.id,
-                    original_url=url,
-                    rank=idx
-                )
-                db.add(img)
+    rows = []
+    image_urls = {}
+    for item in items:
+        row = listing_row(item, compute_content_hash(item))
+        rows.append(row)
+        image_urls[row['item_id']] = picture_urls(item)
+
+    # Existing rows: skip unchanged, UPDATE if changed, INSERT if new
+    result = upsert_listings(db, rows, image_urls, archive=get_archive())
+    skus = {row['item_id']: row['sku'] for row in rows}
+    for item_id in result['updated']:
+        print(f"  Updated: {skus[item_id]}")
+    for item_id in result['new']:
+        print(f"  New: {skus[item_id]}")
 
+    if checkpoint is not None:
+        set_sync_state(db, EXTRACTION_CURSOR_KEY, json.dumps(checkpoint))
     db.commit()
-    print("Listings saved to DB.")
+    for key in counts:
+        counts[key] = len(result[key])
+    print(f"Listings saved to DB ({counts['new']} new, {counts['updated']} updated, {counts['unchanged']} unchanged).")
+    return counts
@@ -1,18 +1,23 @@
 import sys
 import os
+from dotenv import load_dotenv
+
+# Load env if exists. Before the project imports: they read their settings
+# (EBAY_MIGRATION_DB_URL, worker counts, ...) from the environment at import time.
+load_dotenv(override=True)
+
 from sqlalchemy.orm import Session
 from db import init_db
 from auth import EbayAuth
-from listings import fetch_active_listings, parse_and_save_listings
+from listings import extract_active_listings, get_last_extraction_time
 from images import download_images
 from policies import fetch_policies, save_source_policies, sync_to_target
 from upload_images import upload_to_eps
+from image_pipeline import stream_images_to_eps
+from eps_refresh import refresh_expiring_images
 from publish import publish_listings
 from verify import verify_migrations
-from dotenv import load_dotenv
-
-# Load env if exists
-load_dotenv(override=True)
+from stages import backfill_stages, sync_image_stages, stage_stats, print_stage_stats
 
 APP_ID = os.getenv("EBAY_APP_ID")
 CERT_ID = os.getenv("EBAY_CERT_ID")
@@ -83,6 +88,7 @@ def main():
 
     engine = init_db()
     db = Session(engine)
+    backfill_stages(db)
 
     while True:
         print("\n=== eBay Listing Migrator ===")
@@ -92,6 +98,9 @@ def main():
         print("4. Upload Images to TARGET (EPS)")
         print("5. Publish Listings to TARGET")
         print("6. Verify Migrated Listings")
+        print("7. Stream Images SOURCE -> TARGET EPS (Steps 2+4 in one pass, no local copy)")
+        print("8. Re-upload EPS Images About to Expire (unpublished listings only)")
+        print("9. Show Progress per Stage (counts, throughput, latency)")
         print("q. Quit")
         
         choice = input("Select step: ")
@@ -105,11 +114,15 @@ def main():
                 save_source_policies(db, pols, p_type)
             
             print("Fetching Listings...")
-            resp, api = fetch_active_listings(token)
-            parse_and_save_listings(db, resp, api)
+            incremental = False
+            if get_last_extraction_time(db):
+                print("Only fetch listings changed since the last extraction? (y/n)")
+                incremental = input("Selection: ").strip().lower() == 'y'
+            extract_active_listings(db, token, incremental=incremental)
             
         elif choice == '2':
             download_images(db)
+            sync_image_stages(db)
             
         elif choice == '3':
             # Ask if we need source data
@@ -127,6 +140,7 @@ def main():
         elif choice == '4':
             tgt_token = get_validated_token('target')
             upload_to_eps(db, tgt_token)
+            sync_image_stages(db)
             
         elif choice == '5':
             tgt_token = get_validated_token('target')
@@ -137,6 +151,20 @@ def main():
             tgt_token = get_validated_token('target')
             verify_migrations(db, tgt_token)
             
+        elif choice == '7':
+            tgt_token = get_validated_token('target')
+            stream_images_to_eps(db, tgt_token)
+            sync_image_stages(db)
+            
+        elif choice == '8':
+            print("Also re-upload images uploaded before expiry dates were tracked? (y/n)")
+            include_unknown = input("Selection: ").strip().lower() == 'y'
+            tgt_token = get_validated_token('target')
+            refresh_expiring_images(db, tgt_token, include_unknown=include_unknown)
+
+        elif choice == '9':
+            print_stage_stats(stage_stats(db))
+            
         elif choice == 'q':
             break
 
@@ -0,0 +1,165 @@
+"""
+Perceptual-hash near-duplicate detection for EPS uploads.
+
+Byte-identical images already share one upload (content_sha256). Listings often
+reuse the same photo at other sizes or recompressions too, which hash
+differently. A 64-bit difference hash (dHash) of each local image makes those
+near-duplicates findable, so they can reuse an existing new_eps_url.
+
+Off unless EBAY_PHASH_MAX_DISTANCE is set (bits that may differ, e.g. 4). Keep
+it low: similar shots of different products (variants, colours) can come out
+close. Needs Pillow.
+"""
+import os
+from sqlalchemy import or_
+from db import ListingImage
+from image_transform import create_transform_pool
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+_max_distance = os.getenv("EBAY_PHASH_MAX_DISTANCE", "")
+PHASH_MAX_DISTANCE = int(_max_distance) if _max_distance.strip() else None
+
+HASH_BITS = 64
+
+def phash_enabled(max_distance=PHASH_MAX_DISTANCE):
+    return Image is not None and max_distance is not None
+
+def dhash_file(path):
+    """64-bit difference hash of an image file, as 16 hex chars (None if unreadable)."""
+    try:
+        with Image.open(path) as im:
+            # 9x8 greyscale: each bit says whether a pixel is brighter than its right neighbour
+            small = im.convert('L').resize((9, 8), Image.LANCZOS)
+            pixels = list(small.getdata())
+    except Exception:
+        return None
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return f"{value:016x}"
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+class PHashIndex:
+    """
+    Multi-index hashing over 64-bit hashes.
+
+    The hash is split into max_distance + 1 disjoint bit ranges. Two hashes within
+    max_distance bits of each other must agree exactly on at least one range
+    (pigeonhole), so a lookup only compares against entries sharing a range
+    value instead of scanning every stored hash.
+    """
+
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        parts = min(max_distance + 1, HASH_BITS)
+        bounds = [round(i * HASH_BITS / parts) for i in range(parts + 1)]
+        self._ranges = [(bounds[i], bounds[i + 1] - bounds[i]) for i in range(parts)]
+        self._tables = [{} for _ in self._ranges]
+
+    def _keys(self, value):
+        return [(value >> shift) & ((1 << width) - 1) for shift, width in self._ranges]
+
+    def add(self, hex_hash, payload):
+        value = int(hex_hash, 16)
+        for table, key in zip(self._tables, self._keys(value)):
+            table.setdefault(key, []).append((value, payload))
+
+    def find(self, hex_hash):
+        """Payload of the closest stored hash within max_distance, or None."""
+        value = int(hex_hash, 16)
+        best = None
+        best_distance = self.max_distance + 1
+        for table, key in zip(self._tables, self._keys(value)):
+            for candidate, payload in table.get(key, ()):
+                distance = hamming(value, candidate)
+                if distance < best_distance:
+                    best, best_distance = payload, distance
+                    if distance == 0:
+                        return best
+        return best
+
+def compute_missing_phashes(db, writer):
+    """Hash local images that have no phash yet (in a process pool). Returns the count hashed."""
+    by_path = {}
+    for img_id, local_path in db.query(ListingImage.id, ListingImage.local_path).filter(
+        ListingImage.local_path != None,
+        ListingImage.phash == None
+    ):
+        if os.path.exists(local_path):
+            by_path.setdefault(local_path, []).append(img_id)
+    if not by_path:
+        return 0
+
+    print(f"Computing perceptual hashes for {len(by_path)} images...")
+    paths = list(by_path)
+    hashed = 0
+    with create_transform_pool() as pool:
+        for path, value in zip(paths, pool.map(dhash_file, paths, chunksize=32)):
+            if value:
+                writer.put([{'id': iid, 'phash': value} for iid in by_path[path]])
+                hashed += 1
+    return hashed
+
+def reuse_similar_uploads(db, max_distance=PHASH_MAX_DISTANCE, valid_until=None):
+    """
+    Give pending local images the EPS URL of an uploaded near-duplicate.
+    valid_until: ignore uploads known to expire before this time.
+    Returns the number of images resolved without an upload.
+    """
+    index = PHashIndex(max_distance)
+    query = db.query(ListingImage).filter(ListingImage.phash != None, ListingImage.new_eps_url != None)
+    if valid_until:
+        query = query.filter(or_(ListingImage.eps_expires_at == None, ListingImage.eps_expires_at > valid_until))
+    for img in query:
+        index.add(img.phash, img)
+
+    reused = 0
+    for img in db.query(ListingImage).filter(
+        ListingImage.phash != None,
+        ListingImage.local_path != None,
+        ListingImage.new_eps_url == None
+    ):
+        source = index.find(img.phash)
+        if source:
+            img.new_eps_url = source.new_eps_url
+            img.eps_uploaded_at = source.eps_uploaded_at
+            img.eps_expires_at = source.eps_expires_at
+            reused += 1
+    db.commit()
+    return reused
+
+def cluster_near_duplicates(by_content, local_paths, phashes, max_distance=PHASH_MAX_DISTANCE):
+    """
+    Merge pending upload groups whose images are near-duplicates, so each cluster
+    is uploaded once. The largest file of a cluster (usually the highest
+    resolution) is the one uploaded.
+    by_content: {content key: [image ids]}, local_paths/phashes: {content key: value}.
+    Returns a new {content key: [image ids]}.
+    """
+    def size(key):
+        try:
+            return os.path.getsize(local_paths[key])
+        except OSError:
+            return 0
+
+    index = PHashIndex(max_distance)
+    clusters = {}
+    for key in sorted(by_content, key=size, reverse=True):
+        value = phashes.get(key)
+        representative = index.find(value) if value else None
+        if representative is None:
+            clusters[key] = list(by_content[key])
+            if value:
+                index.add(value, key)
+        else:
+            clusters[representative].extend(by_content[key])
+    return clusters
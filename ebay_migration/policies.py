@@ -7,6 +7,24 @@ import os
 
 ACCOUNT_API_URL = "https://api.ebay.com/sell/account/v1"
 
+# {source policy_id: target_policy_id}, loaded on first use and dropped by sync_to_target
+_policy_mapping = None
+
+def get_policy_mapping(db: Session, refresh=False):
+    """Source -> Target policy ID map, read from the DB once and then served from memory."""
+    global _policy_mapping
+    if _policy_mapping is None or refresh:
+        _policy_mapping = {
+            policy_id: target_id
+            for policy_id, target_id in db.query(SourcePolicy.policy_id, SourcePolicy.target_policy_id)
+            if target_id
+        }
+    return _policy_mapping
+
+def invalidate_policy_mapping():
+    global _policy_mapping
+    _policy_mapping = None
+
 def fetch_policies(access_token, policy_type):
     """
     Fetch all policies of a given type (fulfillment, payment, return).
@@ -96,6 +114,7 @@ def sync_to_target(db: Session, source_token, target_token):
     Create or Update.
     """
     policy_types = ['fulfillment', 'payment', 'return']
+    invalidate_policy_mapping() # Mappings are about to change
     
     for p_type in policy_types:
         # 1. Get existing policies on Target
@@ -209,6 +228,7 @@ def sync_to_target(db: Session, source_token, target_token):
                     print(f"Failed to create {policy_name}: {resp.text}")
                     
         db.commit()
+        invalidate_policy_mapping()
 
 # Main Entry (for testing)
 if __name__ == "__main__":
@@ -1,20 +1,52 @@
 import requests
 import json
-from sqlalchemy.orm import Session
-from db import Listing, SourcePolicy
+from sqlalchemy import exists
+from sqlalchemy.orm import Session, selectinload, defer
+from db import Listing, ListingImage, ListingStage
+from archive import load_raw_listing
+from policies import get_policy_mapping
+from claims import claim_listings, renew_claim, release_claims
+from stages import at_stage, advance_stage, record_stage_error
 import uuid
 
 INVENTORY_API_URL = "https://api.ebay.com/sell/inventory/v1"
 
+# Listings claimed and loaded per query while publishing (one IN (...) of claimed
+# IDs; SQLite caps bound parameters). Only one chunk is claimed and held in
+# memory at a time.
+CLAIM_LOAD_CHUNK = 500
+
+# Stages a listing can be published from: every image is on EPS
+PUBLISH_READY_STAGES = ['images_eps', 'item_put', 'offer_created']
+
 def get_target_policy_id(db: Session, source_id):
-    """Resolve Source Policy ID -> Target Policy ID"""
+    """Resolve Source Policy ID -> Target Policy ID (from the in-memory mapping)"""
     if not source_id: return None
-    mapping = db.query(SourcePolicy).filter_by(policy_id=source_id).first()
-    if mapping and mapping.target_policy_id:
-        return mapping.target_policy_id
+    target_id = get_policy_mapping(db).get(source_id)
+    if target_id:
+        return target_id
     print(f"Warning: No mapping found for source policy {source_id}")
     return None
 
+POLICY_FIELDS = [
+    ('payment', 'payment_policy_id'),
+    ('shipping', 'shipping_policy_id'),
+    ('return', 'return_policy_id'),
+]
+
+def find_unmapped_policies(listings, mapping):
+    """
+    Policies the given listings need that have no Target mapping.
+    Returns {(policy kind, source policy id or None): listing count}.
+    """
+    unmapped = {}
+    for item in listings:
+        for kind, field in POLICY_FIELDS:
+            source_id = getattr(item, field)
+            if not source_id or source_id not in mapping:
+                unmapped[(kind, source_id)] = unmapped.get((kind, source_id), 0) + 1
+    return unmapped
+
 # Map Numeric IDs (Trading API) to Enum (Inventory API)
 # Ref: https://developer.ebay.com/api-docs/sell/inventory/types/slr:ConditionEnum
 CONDITION_MAP = {
@@ -42,36 +74,111 @@ def publish_listings(db: Session, target_token):
     2. Create Offer.
     3. Publish Offer.
     """
-    headers = {
-        "Authorization": f"Bearer {target_token}",
-        "Content-Type": "application/json",
-        "Content-Language": "en-US"
-    }
-    
-    listings = db.query(Listing).filter(Listing.migrated == False).all()
-    
-    if not listings:
+    ready = [Listing.migrated == False, at_stage(*PUBLISH_READY_STAGES)]
+    waiting = db.query(ListingStage).filter(ListingStage.stage.in_(['extracted', 'images_local']))
+    # A listing without any photo never gets past 'extracted'; Steps 2 and 4 can't help it
+    no_images = waiting.filter(~exists().where(ListingImage.listing_id == ListingStage.listing_id)).count()
+    waiting = waiting.count() - no_images
+    if waiting:
+        print(f"{waiting} listings still have images that are not on EPS yet (Steps 2 and 4); they are skipped.")
+    if no_images:
+        print(f"{no_images} listings have no photos on the source listing (eBay needs at least one); they are skipped.")
+    pending = db.query(Listing).filter(*ready).count()
+    if not pending:
         print("No pending listings found.")
         return
 
-    print(f"Found {len(listings)} pending items.")
+    print(f"Found {pending} pending items.")
     limit_input = input("How many to publish? (enter number or 'all'): ").strip().lower()
-    
-    limit = len(listings)
+
+    limit = None
     if limit_input != 'all':
-        try:
-            limit = int(limit_input)
-        except ValueError:
+        # Positive numbers only: a negative LIMIT would claim everything on SQLite
+        if not limit_input.isdigit() or int(limit_input) < 1:
             print("Invalid input. Exiting.")
             return
+        limit = int(limit_input)
+
+    # Listings are claimed a chunk at a time as the batch reaches them, so other
+    # workers on the same DB publish different listings
+    listings = _claimed_listings(db, ready, limit)
 
-    print(f"Starting migration for {limit} listings...")
+    # Progress is committed after every listing. Without this, each commit would
+    # expire all loaded listings and their images, costing fresh SELECTs per row.
+    expire_on_commit = db.expire_on_commit
+    db.expire_on_commit = False
+    try:
+        _publish_batch(db, target_token, ready, limit, listings)
+    finally:
+        db.expire_on_commit = expire_on_commit
+        listings.close() # releases the chunk still claimed
+
+def _claimed_listings(db: Session, ready, limit):
+    """
+    Yield up to limit ready listings in ID order. They are claimed
+    CLAIM_LOAD_CHUNK at a time, just before the batch gets to them, and each
+    chunk is released once done, so no claim has to last the whole batch.
+    Each listing's claim is renewed right before it is yielded; one whose
+    lease ran out and was taken by another worker, or that got published
+    meanwhile, is skipped. Only one chunk is held in memory at a time.
+    """
+    # Images in one SELECT per chunk of listings instead of one per listing;
+    # variations_json isn't used here (raw_listing_json is deferred on the model)
+    query = db.query(Listing).options(
+        selectinload(Listing.images),
+        defer(Listing.variations_json)
+    ).order_by(Listing.id)
+    after_id = 0
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = CLAIM_LOAD_CHUNK if remaining is None else min(CLAIM_LOAD_CHUNK, remaining)
+        # Past the last chunk, so listings that failed (and stay ready) aren't claimed again
+        chunk = claim_listings(db, ready + [Listing.id > after_id], size)
+        if not chunk:
+            if not after_id:
+                print("All pending listings are claimed by other workers.")
+            return
+        try:
+            for item in query.filter(Listing.id.in_(chunk)).all():
+                if renew_claim(db, item.id, [Listing.migrated == False]):
+                    yield item
+                else:
+                    print(f"Skipping {item.sku}: taken over by another worker or already published.")
+        finally:
+            db.rollback()
+            release_claims(db, chunk)
+        after_id = chunk[-1]
+        if remaining is not None:
+            remaining -= len(chunk)
+
+def _publish_batch(db: Session, target_token, ready, limit, listings):
+    headers = {
+        "Authorization": f"Bearer {target_token}",
+        "Content-Type": "application/json",
+        "Content-Language": "en-US"
+    }
+    
+    # Check every policy this batch needs up front (policy columns only, no full rows),
+    # rather than stopping at the first listing with an unmapped policy
+    mapping = get_policy_mapping(db, refresh=True)
+    policy_rows = db.query(
+        Listing.payment_policy_id, Listing.shipping_policy_id, Listing.return_policy_id
+    ).filter(*ready).order_by(Listing.id).limit(limit).yield_per(CLAIM_LOAD_CHUNK)
+    unmapped = find_unmapped_policies(policy_rows, mapping)
+    if unmapped:
+        print("Stopping: some listings in this batch use policies with no TARGET mapping:")
+        for (kind, source_id), count in sorted(unmapped.items(), key=lambda e: -e[1]):
+            label = f"source policy {source_id}" if source_id else "no policy on the source listing"
+            print(f"  - {kind}: {label} ({count} listings)")
+        print("Run Step 3 (Sync Policies to TARGET) and re-run.")
+        return
+
+    total = db.query(Listing).filter(*ready).count()
+    if limit is not None:
+        total = min(total, limit)
+    print(f"Starting migration for up to {total} listings...")
     
     for idx, item in enumerate(listings):
-        if idx >= limit:
-            print(f"Reached batch limit of {limit}.")
-            break
-                
         try:
             # --- PREPARE DATA ---
             # 1. Images (Must be new EPS URLs)
@@ -142,7 +249,7 @@ def publish_listings(db: Session, target_token):
             
             # Prepare package weight and dimensions
             package_details = None
-            raw = item.raw_listing_json or {}
+            raw = load_raw_listing(item) # Lazy: read from the raw archive only here
             if 'ShippingPackageDetails' in raw:
                 pkg = raw['ShippingPackageDetails']
                 if isinstance(pkg, list): pkg = pkg[0]
@@ -285,11 +392,13 @@ def publish_listings(db: Session, target_token):
             if resp.status_code not in [200, 204]:
                 print(f"Failed to create/update inventory item {sku}: {resp.text}")
                 item.migration_error = f"Item Create: {resp.status_code} {resp.text}"
+                record_stage_error(db, item.id, item.migration_error)
                 db.commit()
                 print("⚠️ Stopping batch due to error. Fix the issue and re-run.")
                 return
             elif idx == 0:
                 print(f"  Inventory item {sku} updated successfully (Status: {resp.status_code})")
+            advance_stage(db, [item.id], 'item_put')
 
                 
             # --- STEP 2: CREATE OFFER ---
@@ -360,6 +469,7 @@ def publish_listings(db: Session, target_token):
             if not offer_id:
                 print(f"Failed to create/resolve offer for {sku}: {resp.text}")
                 item.migration_error = f"Offer Create: {resp.status_code} {resp.text}"
+                record_stage_error(db, item.id, item.migration_error)
                 db.commit()
                 print("⚠️ Stopping batch due to error. Fix the issue and re-run.")
                 return
@@ -372,11 +482,13 @@ def publish_listings(db: Session, target_token):
             if resp.status_code not in [200, 204]:
                 print(f"Failed to update offer {offer_id}: {resp.text}")
                 item.migration_error = f"Offer Update: {resp.status_code} {resp.text}"
+                record_stage_error(db, item.id, item.migration_error)
                 db.commit()
                 print("⚠️ Stopping batch due to error. Fix the issue and re-run.")
                 return
                  
             item.new_offer_id = offer_id
+            advance_stage(db, [item.id], 'offer_created')
             
             # --- STEP 3: PUBLISH OFFER ---
             if offer_id:
@@ -387,9 +499,11 @@ def publish_listings(db: Session, target_token):
                     print(f"SUCCESS: Published {sku} (Offer: {offer_id})")
                     item.migrated = True
                     item.migration_error = None
+                    advance_stage(db, [item.id], 'published')
                 else:
                     print(f"Failed to publish {sku}: {resp.text}")
                     item.migration_error = f"Publish: {resp.status_code} {resp.text}"
+                    record_stage_error(db, item.id, item.migration_error)
                     db.commit()
                     print("⚠️ Stopping batch due to error. Fix the issue and re-run.")
                     return
@@ -397,11 +511,12 @@ def publish_listings(db: Session, target_token):
             
             db.commit()
             
-            print(f"✓ Published {item.sku}. ({idx+1}/{limit})")
+            print(f"✓ Published {item.sku}. ({idx+1}/{total})")
 
         except Exception as e:
             print(f"Exception processing {item.sku}: {e}")
             item.migration_error = str(e)
+            record_stage_error(db, item.id, item.migration_error)
             db.commit()
             print("⚠️ Stopping batch due to error. Fix the issue and re-run.")
             return
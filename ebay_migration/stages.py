@@ -0,0 +1,180 @@
+"""
+Per-listing pipeline stages (db.STAGES), kept in listing_stages.
+
+listing_stages holds one row per listing with the furthest stage reached.
+Publish picks its candidates through the (stage, listing_id) index (at_stage)
+instead of scanning listings for flags. The image steps work per image, so they
+still find their work from the image columns; sync_image_stages then promotes
+the listings they completed. The per-stage timestamps also give throughput and
+latency for each stage (stage_stats).
+"""
+import datetime
+from sqlalchemy import exists, func, insert, literal, or_, select, update
+from sqlalchemy.orm import Session
+from db import STAGES, Listing, ListingImage, ListingStage
+
+_CHUNK_SIZE = 500
+
+def stage_at_column(stage):
+    return getattr(ListingStage, f"{stage}_at")
+
+def at_stage(*stages):
+    """Listing filter: listings whose furthest stage is one of stages."""
+    return Listing.id.in_(select(ListingStage.listing_id).where(ListingStage.stage.in_(stages)))
+
+def new_stage_rows(listing_ids, now=None):
+    """listing_stages rows for freshly extracted listings."""
+    now = now or datetime.datetime.utcnow()
+    return [
+        {'listing_id': listing_id, 'stage': 'extracted', 'attempts': 0, 'extracted_at': now, 'updated_at': now}
+        for listing_id in listing_ids
+    ]
+
+def _promote(db: Session, stage, condition, stamp=True):
+    """Move rows matching condition that are before stage up to it. Returns the row count."""
+    now = datetime.datetime.utcnow()
+    values = {'stage': stage, 'attempts': 0, 'last_error': None, 'updated_at': now}
+    if stamp:
+        values[f"{stage}_at"] = now
+    result = db.execute(
+        update(ListingStage)
+        .where(ListingStage.stage.in_(STAGES[:STAGES.index(stage)]), condition)
+        .values(values),
+        execution_options={'synchronize_session': False}
+    )
+    return result.rowcount
+
+def advance_stage(db: Session, listing_ids, stage):
+    """Record that listings reached stage (never moves a listing back). Does not commit."""
+    listing_ids = list(listing_ids)
+    for start in range(0, len(listing_ids), _CHUNK_SIZE):
+        _promote(db, stage, ListingStage.listing_id.in_(listing_ids[start:start + _CHUNK_SIZE]))
+
+def record_stage_error(db: Session, listing_id, error):
+    """Count a failed try at the listing's next stage. Does not commit."""
+    db.execute(
+        update(ListingStage)
+        .where(ListingStage.listing_id == listing_id)
+        .values(
+            attempts=func.coalesce(ListingStage.attempts, 0) + 1,
+            last_error=error,
+            updated_at=datetime.datetime.utcnow()
+        ),
+        execution_options={'synchronize_session': False}
+    )
+
+def _images_done(column):
+    """
+    Every image of the listing has column set (or is already on EPS), and at
+    least one does. Images whose source has no usable size (resolved_url '')
+    can never be fetched, so they don't hold the listing back.
+    """
+    listing_images = ListingImage.listing_id == ListingStage.listing_id
+    return exists().where(listing_images, column != None) & ~exists().where(
+        listing_images,
+        column == None,
+        ListingImage.new_eps_url == None,
+        or_(ListingImage.resolved_url == None, ListingImage.resolved_url != '')
+    )
+
+def sync_image_stages(db: Session):
+    """
+    Promote listings whose images are all local / all on EPS. Run at the end of
+    the image steps: one pass over listings not past images_local, not over every image.
+    Commits. Returns (listings now images_local, listings now images_eps).
+    """
+    on_eps = _promote(db, 'images_eps', _images_done(ListingImage.new_eps_url))
+    local = _promote(db, 'images_local', _images_done(ListingImage.local_path))
+    db.commit()
+    if local or on_eps:
+        print(f"Stages: {local} listings now have all images local, {on_eps} have all images on EPS.")
+    return local, on_eps
+
+def backfill_stages(db: Session):
+    """
+    Create stage rows for listings that have none (extracted before stages were
+    tracked, or after a reset script dropped them), derived from the existing
+    flags. Backfilled stages get no timestamps. Commits. Returns the number of rows created.
+    """
+    created = db.execute(
+        insert(ListingStage).from_select(
+            ['listing_id', 'stage', 'attempts'],
+            select(Listing.id, literal('extracted'), literal(0)).where(
+                ~exists().where(ListingStage.listing_id == Listing.id)
+            )
+        )
+    ).rowcount
+    if not created:
+        return 0
+
+    _promote(db, 'images_eps', _images_done(ListingImage.new_eps_url), stamp=False)
+    _promote(db, 'images_local', _images_done(ListingImage.local_path), stamp=False)
+    _promote(db, 'offer_created', ListingStage.listing_id.in_(
+        select(Listing.id).where(Listing.new_offer_id != None)
+    ), stamp=False)
+    _promote(db, 'published', ListingStage.listing_id.in_(
+        select(Listing.id).where(Listing.migrated == True)
+    ), stamp=False)
+    db.commit()
+    print(f"Stages: tracked {created} more listings (stage derived from existing data).")
+    return created
+
+def _seconds_between(start, end, dialect_name):
+    if dialect_name == 'sqlite':
+        return (func.julianday(end) - func.julianday(start)) * 86400
+    if dialect_name == 'postgresql':
+        return func.extract('epoch', end - start)
+    return None
+
+def stage_stats(db: Session):
+    """
+    Per stage: listings currently there, how many of those failed their next
+    step at least once, how many reached it (with a timestamp), completions per
+    hour over the stage's active window, and average seconds from the previous stage.
+    """
+    dialect_name = db.get_bind().dialect.name
+    current = dict(db.query(ListingStage.stage, func.count()).group_by(ListingStage.stage))
+    failing = dict(
+        db.query(ListingStage.stage, func.count()).filter(ListingStage.attempts > 0).group_by(ListingStage.stage)
+    )
+    stats = []
+    for i, stage in enumerate(STAGES):
+        reached_at = stage_at_column(stage)
+        reached, first, last = db.query(func.count(reached_at), func.min(reached_at), func.max(reached_at)).one()
+        span = (last - first).total_seconds() if reached > 1 else 0
+
+        avg_seconds = None
+        if i > 0:
+            # Latest earlier stage with a timestamp (stages can be skipped)
+            earlier = [stage_at_column(s) for s in reversed(STAGES[:i])]
+            previous_at = func.coalesce(*earlier) if len(earlier) > 1 else earlier[0]
+            elapsed = _seconds_between(previous_at, reached_at, dialect_name)
+            if elapsed is not None:
+                avg_seconds = db.query(func.avg(elapsed)).filter(reached_at != None, previous_at != None).scalar()
+
+        stats.append({
+            'stage': stage,
+            'current': current.get(stage, 0),
+            'failing': failing.get(stage, 0),
+            'reached': reached,
+            'per_hour': reached / span * 3600 if span else None,
+            'avg_seconds': float(avg_seconds) if avg_seconds is not None else None,
+        })
+    return stats
+
+def _duration(seconds):
+    if seconds is None:
+        return "-"
+    if seconds < 120:
+        return f"{seconds:.0f}s"
+    if seconds < 7200:
+        return f"{seconds / 60:.1f}m"
+    return f"{seconds / 3600:.1f}h"
+
+def print_stage_stats(stats):
+    print(f"{'Stage':<15}{'Now at':>9}{'Failing':>9}{'Reached':>9}{'Per hour':>10}  Avg time from previous")
+    for row in stats:
+        per_hour = f"{row['per_hour']:.0f}" if row['per_hour'] is not None else "-"
+        print(f"{row['stage']:<15}{row['current']:>9}{row['failing']:>9}{row['reached']:>9}{per_hour:>10}  "
+              f"{_duration(row['avg_seconds'])}")
+    print("'Failing' = listings whose next step failed at least once (see listing_stages.last_error).")
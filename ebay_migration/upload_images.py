@@ -1,83 +1,211 @@
 from ebaysdk.trading import Connection as Trading
-from sqlalchemy.orm import Session, sessionmaker
-from db import ListingImage, init_db
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+from db import ListingImage, SessionLocal
+from writer import BatchWriter
+from images import touch_blob
+from image_cache import enforce_cache_limit
+from phash import (
+    PHASH_MAX_DISTANCE, phash_enabled, compute_missing_phashes, reuse_similar_uploads,
+    cluster_near_duplicates
+)
+from image_transform import (
+    transform_enabled, prepare_upload_file, discard_upload_file, create_transform_pool
+)
 import os
+import datetime
+import threading
 import concurrent.futures
 from functools import partial
 
-# Create a scoped session factory for thread safety
-SessionLocal = sessionmaker(bind=init_db())
+UPLOAD_WORKERS = int(os.getenv("EBAY_UPLOAD_WORKERS", 4))
 
-def upload_single_image(img_id, oauth_token):
+# Days EPS keeps a picture that no listing uses yet
+EPS_EXTENSION_DAYS = 30
+# Pictures expiring within this many days are re-uploaded rather than reused
+EPS_REFRESH_MARGIN_DAYS = int(os.getenv("EBAY_EPS_REFRESH_MARGIN_DAYS", 7))
+
+_thread_local = threading.local()
+
+def create_upload_api(oauth_token):
+    """Trading API connection for EPS uploads (longer timeout for file bodies)."""
+    return Trading(
+        appid=os.getenv("EBAY_APP_ID"), 
+        certid=os.getenv("EBAY_CERT_ID"),
+        devid=os.getenv("EBAY_DEV_ID"),
+        iaf_token=oauth_token,
+        siteid='0',
+        timeout=60,
+        config_file=None
+    )
+
+def thread_upload_api(oauth_token):
+    """
+    One Trading connection per worker thread (ebaysdk connections are not thread-safe).
+    Reusing it keeps the underlying HTTP keep-alive pool warm across uploads.
+    """
+    if getattr(_thread_local, 'token', None) != oauth_token:
+        _thread_local.api = create_upload_api(oauth_token)
+        _thread_local.token = oauth_token
+    return _thread_local.api
+
+def eps_expiry(details, uploaded_at):
+    """Expiry from the response's UseByDate, else the requested extension."""
+    use_by = details.get('UseByDate')
+    if use_by:
+        try:
+            parsed = datetime.datetime.fromisoformat(use_by.replace('Z', '+00:00'))
+            return parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        except ValueError:
+            pass
+    return uploaded_at + datetime.timedelta(days=EPS_EXTENSION_DAYS)
+
+def upload_picture(api, filename, fileobj):
     """
-    Worker function to upload a single image.
-    Uses its own DB session to be thread-safe.
+    UploadSiteHostedPictures for one file object.
+    Returns (EPS FullURL or None, UTC expiry).
     """
-    db = SessionLocal()
+    files = {'file': (filename, fileobj)}
+    uploaded_at = datetime.datetime.utcnow()
+    
+    # API Call: UploadSiteHostedPictures
+    response = api.execute('UploadSiteHostedPictures', { 
+        'ExtensionInDays': EPS_EXTENSION_DAYS,
+    }, files=files)
+    
+    details = response.dict().get('SiteHostedPictureDetails', {})
+    return details.get('FullURL'), eps_expiry(details, uploaded_at)
+
+def eps_url_rows(img_ids, full_url, expires_at):
+    """BatchWriter rows recording an EPS upload for every image in img_ids."""
+    uploaded_at = datetime.datetime.utcnow()
+    return [
+        {'id': iid, 'new_eps_url': full_url, 'eps_uploaded_at': uploaded_at, 'eps_expires_at': expires_at}
+        for iid in img_ids
+    ]
+
+def upload_single_image(img_ids, local_path, oauth_token, writer, upload_path=None):
+    """
+    Worker function to upload a single image file.
+    img_ids are all ListingImage rows backed by that same file; they all get the EPS URL.
+    upload_path: shrunk copy to send instead of the original (removed afterwards,
+    whatever the outcome; a failed upload shrinks it again next run).
+    The worker never touches the DB: its result goes to the shared BatchWriter.
+    """
+    img_id = img_ids[0]
     try:
-        img = db.query(ListingImage).get(img_id)
-        if not img or not img.local_path or not os.path.exists(img.local_path):
-            return f"Skipped (Missing): {img.local_path if img else 'Unknown'}"
-
-        api = Trading(
-            appid=os.getenv("EBAY_APP_ID"), 
-            certid=os.getenv("EBAY_CERT_ID"),
-            devid=os.getenv("EBAY_DEV_ID"),
-            iaf_token=oauth_token,
-            siteid='0',
-            timeout=60,
-            config_file=None
-        )
-        
-        files = {'file': (img.local_path, open(img.local_path, 'rb'))}
-        
-        # API Call: UploadSiteHostedPictures
-        response = api.execute('UploadSiteHostedPictures', { 
-            'ExtensionInDays': 30,
-        }, files=files)
-        
-        resp_dict = response.dict()
-        full_url = resp_dict.get('SiteHostedPictureDetails', {}).get('FullURL')
+        if not local_path or not os.path.exists(local_path):
+            return f"Skipped (Missing): {local_path or 'Unknown'}"
+
+        path = upload_path or local_path
+        with open(path, 'rb') as f:
+            full_url, expires_at = upload_picture(thread_upload_api(oauth_token), path, f)
         
         if full_url:
-            img.new_eps_url = full_url
-            db.commit()
-            return f"Success: {img.local_path} -> {full_url}"
+            touch_blob(local_path)
+            writer.put(eps_url_rows(img_ids, full_url, expires_at))
+            shared = f" (shared by {len(img_ids)} images)" if len(img_ids) > 1 else ""
+            return f"Success: {local_path} -> {full_url}{shared}"
         else:
-            return f"Failed (No URL): {img.local_path}"
+            return f"Failed (No URL): {local_path}"
 
     except Exception as e:
         return f"Error {img_id}: {str(e)}"
     finally:
-        db.close()
+        if upload_path:
+            discard_upload_file(upload_path, local_path)
+
+def content_key(img):
+    """Images with identical bytes share one upload (legacy rows fall back to the file path)."""
+    return img.content_sha256 or img.local_path
+
+def reuse_uploaded_images(db: Session, valid_until=None):
+    """
+    Give pending images the EPS URL of an already-uploaded image with identical content.
+    Sources are matched on content_sha256, so an uploaded image whose local file
+    was evicted from the cache still counts.
+    valid_until: only reuse URLs that are not known to expire before this time.
+    Returns the number of images resolved without an upload.
+    """
+    uploaded = {}
+    query = db.query(ListingImage).filter(
+        ListingImage.new_eps_url != None,
+        or_(ListingImage.content_sha256 != None, ListingImage.local_path != None)
+    )
+    if valid_until:
+        query = query.filter(or_(ListingImage.eps_expires_at == None, ListingImage.eps_expires_at > valid_until))
+    for img in query:
+        uploaded[content_key(img)] = img
+    reused = 0
+    for img in db.query(ListingImage).filter(ListingImage.local_path != None, ListingImage.new_eps_url == None):
+        source = uploaded.get(content_key(img))
+        if source:
+            img.new_eps_url = source.new_eps_url
+            img.eps_uploaded_at = source.eps_uploaded_at
+            img.eps_expires_at = source.eps_expires_at
+            reused += 1
+    db.commit()
+    return reused
 
-def upload_to_eps(db: Session, oauth_token):
+def upload_to_eps(db: Session, oauth_token, max_workers=UPLOAD_WORKERS):
     """
     Uploads images in parallel using ThreadPoolExecutor.
+    Each distinct file is uploaded once, even if many listings use it.
     """
-    # 1. Gather all IDs to process
+    valid_until = datetime.datetime.utcnow() + datetime.timedelta(days=EPS_REFRESH_MARGIN_DAYS)
+    reused = reuse_uploaded_images(db, valid_until=valid_until)
+    if reused:
+        print(f"Reused {reused} EPS URLs from identical images already uploaded.")
+
+    use_phash = phash_enabled()
+    if use_phash:
+        with BatchWriter(SessionLocal) as writer:
+            compute_missing_phashes(db, writer)
+        db.expire_all()
+        similar = reuse_similar_uploads(db, valid_until=valid_until)
+        if similar:
+            print(f"Reused {similar} EPS URLs from near-duplicate images (distance <= {PHASH_MAX_DISTANCE}).")
+    elif PHASH_MAX_DISTANCE is not None:
+        print("EBAY_PHASH_MAX_DISTANCE is set but Pillow is not installed; near-duplicate reuse is off.")
+
+    # 1. Gather all IDs to process, grouped by content
     images_to_upload = db.query(ListingImage).filter(
         ListingImage.local_path != None,
         ListingImage.new_eps_url == None
     ).all()
     
-    img_ids = [img.id for img in images_to_upload]
-    total = len(img_ids)
+    by_content = {}
+    local_paths = {}
+    phashes = {}
+    for img in images_to_upload:
+        key = content_key(img)
+        by_content.setdefault(key, []).append(img.id)
+        local_paths.setdefault(key, img.local_path)
+        if img.phash:
+            phashes.setdefault(key, img.phash)
+    if use_phash:
+        by_content = cluster_near_duplicates(by_content, local_paths, phashes)
+    total = len(by_content)
     
     if total == 0:
         print("No images to upload.")
         return
 
-    print(f"Found {total} images. Starting upload with 4 threads...")
+    print(f"Found {len(images_to_upload)} images ({total} unique files). Starting upload with {max_workers} threads...")
     
     # 2. Parallel Execution
-    # We pass IDs instead of objects to avoid DB session threading issues
-    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+    # We pass IDs instead of objects to avoid DB session threading issues;
+    # results are committed in batches by a single writer thread
+    with BatchWriter(SessionLocal) as writer, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         # Create a partial function with the token fixed
-        worker = partial(upload_single_image, oauth_token=oauth_token)
+        worker = partial(upload_single_image, oauth_token=oauth_token, writer=writer)
         
         # Submit all tasks
-        futures = {executor.submit(worker, iid): iid for iid in img_ids}
+        if transform_enabled():
+            futures = _submit_shrunk_uploads(executor, worker, by_content, local_paths)
+        else:
+            futures = {executor.submit(worker, ids, local_paths[key]): ids for key, ids in by_content.items()}
         
         # Process results as they complete
         completed = 0
@@ -86,4 +214,33 @@ def upload_to_eps(db: Session, oauth_token):
             result = future.result()
             print(f"[{completed}/{total}] {result}")
 
+    # Uploaded files are now only a cache; trim the store if it has a size cap
+    enforce_cache_limit(db)
+
+def _submit_shrunk_uploads(executor, worker, by_content, local_paths):
+    """
+    Shrink each file in a process pool and queue its upload as soon as it is ready,
+    so CPU work overlaps with the upload threads.
+    """
+    print("Resizing images before upload (EBAY_UPLOAD_MAX_EDGE=0 to disable)...")
+    futures = {}
+    original_bytes = upload_bytes = 0
+    with create_transform_pool() as pool:
+        prepared = {pool.submit(prepare_upload_file, local_paths[key]): key for key in by_content}
+        for future in concurrent.futures.as_completed(prepared):
+            key = prepared[future]
+            ids = by_content[key]
+            try:
+                upload_path, before, after = future.result()
+                original_bytes += before
+                upload_bytes += after
+            except Exception as e:
+                print(f"Resize failed for {local_paths[key]}, uploading original: {e}")
+                upload_path = None
+            futures[executor.submit(worker, ids, local_paths[key], upload_path=upload_path)] = ids
+    if original_bytes:
+        saved = 100 * (1 - upload_bytes / original_bytes)
+        print(f"Resized: {original_bytes / 1e6:.1f} MB -> {upload_bytes / 1e6:.1f} MB ({saved:.0f}% less to upload)")
+    return futures
+
 
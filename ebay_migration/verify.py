@@ -1,7 +1,8 @@
 import requests
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, selectinload, defer
 from db import Listing, SourcePolicy
 from publish import CONDITION_MAP, get_target_policy_id
+from stages import advance_stage, record_stage_error
 
 INVENTORY_API_URL = "https://api.ebay.com/sell/inventory/v1"
 
@@ -9,24 +10,53 @@ def normalize_text(text):
     if not text: return ""
     return " ".join(text.split()).strip()
 
+# Listings per keyset page (id > last seen); only about one page is in memory at a time
+VERIFY_PAGE_SIZE = 500
+
+def _stream_migrated(db: Session):
+    """Migrated listings in ID order, read one keyset page at a time."""
+    # Images eager-loaded per page; JSON columns the checks don't read stay unloaded
+    query = db.query(Listing).options(
+        selectinload(Listing.images),
+        defer(Listing.product_identifiers_json),
+        defer(Listing.variations_json),
+        defer(Listing.best_offer_json)
+    ).filter(Listing.migrated == True).order_by(Listing.id)
+    last_id = 0
+    while True:
+        page = query.filter(Listing.id > last_id).limit(VERIFY_PAGE_SIZE).all()
+        if not page:
+            return
+        yield from page
+        last_id = page[-1].id
+
 def verify_migrations(db: Session, target_token):
+    # Results are committed as the run goes; keep the loaded page usable across commits
+    expire_on_commit = db.expire_on_commit
+    db.expire_on_commit = False
+    try:
+        _verify_migrated(db, target_token)
+    finally:
+        db.expire_on_commit = expire_on_commit
+
+def _verify_migrated(db: Session, target_token):
     headers = {
         "Authorization": f"Bearer {target_token}",
         "Content-Type": "application/json",
         "Content-Language": "en-US"
     }
 
-    migrated_listings = db.query(Listing).filter(Listing.migrated == True).all()
-    
-    if not migrated_listings:
+    total = db.query(Listing).filter(Listing.migrated == True).count()
+    if not total:
         print("No migrated listings found to verify.")
         return
 
-    print(f"\nVerifying {len(migrated_listings)} migrated listings...")
+    print(f"\nVerifying {total} migrated listings...")
     
     issues_found = 0
+    passed = []
     
-    for idx, item in enumerate(migrated_listings):
+    for idx, item in enumerate(_stream_migrated(db)):
         sku = item.sku
         failures = []
         
@@ -38,6 +68,8 @@ def verify_migrations(db: Session, target_token):
             if inv_resp.status_code != 200:
                 print(f"[FAIL] {sku}: Could not fetch Inventory Item ({inv_resp.status_code})")
                 issues_found += 1
+                record_stage_error(db, item.id, f"Verify: Could not fetch Inventory Item ({inv_resp.status_code})")
+                db.commit()
                 continue
                 
             inv_data = inv_resp.json()
@@ -149,11 +181,24 @@ def verify_migrations(db: Session, target_token):
                 print(f"[FAIL] {sku}")
                 for f in failures:
                     print(f"  - {f}")
+                record_stage_error(db, item.id, "Verify: " + "; ".join(failures))
+                db.commit()
             else:
                 print(f"[PASS] {sku}")
+                passed.append(item.id)
                 
         except Exception as e:
             print(f"[ERR] {sku}: {e}")
             issues_found += 1
+            record_stage_error(db, item.id, f"Verify: {e}")
+            db.commit()
+
+        if len(passed) >= VERIFY_PAGE_SIZE:
+            advance_stage(db, passed, 'verified')
+            db.commit()
+            passed = []
+
+    advance_stage(db, passed, 'verified')
+    db.commit()
 
-    print(f"\nVerification Complete. {issues_found} issues found out of {len(migrated_listings)} items.")
+    print(f"\nVerification Complete. {issues_found} issues found out of {total} items.")
@@ -0,0 +1,109 @@
+"""
+Single-writer commit queue for worker threads.
+
+With SQLite only one connection can write at a time, and every commit is an
+fsync. When each download/upload thread opens a session and commits per image,
+the threads mostly wait on the DB lock. Workers instead hand their results to
+one BatchWriter, which applies them as bulk UPDATEs and commits every
+BATCH_SIZE rows or FLUSH_INTERVAL seconds, whichever comes first.
+"""
+import queue
+import threading
+import time
+from sqlalchemy import bindparam, update
+from db import ListingImage
+
+BATCH_SIZE = 200
+FLUSH_INTERVAL = 1.0
+
+_CLOSE = object()
+
+class BatchWriter:
+    """
+    Background thread applying {'id': ..., <column>: <value>} dicts to one model.
+
+    put() never blocks, so it is safe to call from an event loop. Results that
+    were queued but not committed (e.g. the process is killed) are simply redone
+    on the next run, because the row still looks pending.
+    """
+
+    def __init__(self, session_factory, model=ListingImage, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.session_factory = session_factory
+        self.model = model
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows_written = 0
+        self.commits = 0
+        self.errors = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def put(self, rows):
+        """Queue a list of row dicts (each with the primary key 'id')."""
+        if rows:
+            self._queue.put(rows)
+
+    def close(self):
+        """Flush everything queued so far and stop the writer thread."""
+        self._queue.put(_CLOSE)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _statements(self, batch):
+        """
+        Group rows by the columns they set: one executemany UPDATE per group.
+        Core UPDATEs (not ORM bulk) so a row deleted meanwhile is skipped, not fatal.
+        """
+        table = self.model.__table__
+        groups = {}
+        for row in batch:
+            groups.setdefault(tuple(sorted(k for k in row if k != 'id')), []).append(row)
+        for columns, rows in groups.items():
+            stmt = update(table).where(table.c.id == bindparam('_id')).values(
+                {c: bindparam(c) for c in columns}
+            )
+            yield stmt, [{'_id': r['id'], **{c: r[c] for c in columns}} for r in rows]
+
+    def _apply(self, batch):
+        db = self.session_factory()
+        try:
+            for stmt, params in self._statements(batch):
+                db.execute(stmt, params)
+            db.commit()
+            self.rows_written += len(batch)
+            self.commits += 1
+        except Exception as e:
+            db.rollback()
+            self.errors += 1
+            print(f"DB writer: failed to save {len(batch)} rows, they will be retried next run: {e}")
+        finally:
+            db.close()
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                entry = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                entry = None
+
+            if entry is not None and entry is not _CLOSE:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.extend(entry)
+
+            closing = entry is _CLOSE
+            if batch and (closing or len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._apply(batch)
+                batch = []
+                deadline = None
+            if closing:
+                return
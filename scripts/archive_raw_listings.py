@@ -0,0 +1,48 @@
+from dotenv import load_dotenv
+
+# Before the project imports: ebay_migration.db reads EBAY_MIGRATION_DB_URL at import time
+load_dotenv(override=True)
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from ebay_migration.db import init_db, Listing
+from ebay_migration.archive import get_archive
+
+BATCH_SIZE = 500
+
+def archive_raw_listings():
+    """Move legacy inline raw_listing_json payloads into the compressed raw archive."""
+    engine = init_db()
+    db = Session(engine)
+    archive = get_archive()
+
+    pending = db.query(Listing.id).filter(Listing.raw_listing_json != None, Listing.raw_archive_ref == None).count()
+    print(f"Found {pending} listings with inline raw JSON.")
+    if pending == 0:
+        return
+
+    moved = 0
+    while True:
+        batch = db.query(Listing).filter(
+            Listing.raw_listing_json != None,
+            Listing.raw_archive_ref == None
+        ).order_by(Listing.id).limit(BATCH_SIZE).all()
+        if not batch:
+            break
+        for listing in batch:
+            listing.raw_archive_ref = archive.append(listing.item_id, listing.raw_listing_json)
+            listing.raw_listing_json = None
+        archive.flush()
+        db.commit()
+        moved += len(batch)
+        print(f"  Archived {moved}/{pending}...")
+
+    if engine.dialect.name == 'sqlite':
+        print("Compacting database (VACUUM)...")
+        with engine.connect() as conn:
+            conn.execute(text("VACUUM"))
+
+    print(f"Done. Moved {moved} payloads to {archive.root}.")
+
+if __name__ == "__main__":
+    archive_raw_listings()
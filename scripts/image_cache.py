@@ -0,0 +1,35 @@
+import argparse
+import os
+import sys
+
+# The cache code uses the app's flat imports (db, images, ...), like main.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ebay_migration'))
+
+from dotenv import load_dotenv
+
+# Before the project imports: they read EBAY_IMAGE_CACHE_MAX_MB and the DB URL at import time
+load_dotenv(override=True)
+
+from sqlalchemy.orm import Session
+from db import init_db
+from image_cache import IMAGE_CACHE_MAX_MB, cache_stats, print_cache_stats, enforce_cache_limit
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or trim the local image store (data/images).")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('stats', help="Show usage split by upload state, and evictions so far")
+    evict = sub.add_parser('evict', help="Delete uploaded images, least recently used first, down to a size")
+    evict.add_argument('--max-mb', type=int, default=IMAGE_CACHE_MAX_MB,
+                       help="Target size in MB (default: EBAY_IMAGE_CACHE_MAX_MB)")
+    args = parser.parse_args()
+
+    db = Session(init_db())
+    if args.command == 'evict':
+        if not args.max_mb:
+            print("No size given: pass --max-mb or set EBAY_IMAGE_CACHE_MAX_MB.")
+            return
+        enforce_cache_limit(db, args.max_mb * 1024 * 1024)
+    print_cache_stats(cache_stats(db))
+
+if __name__ == "__main__":
+    main()
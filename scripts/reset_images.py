@@ -1,5 +1,10 @@
+from dotenv import load_dotenv
+
+# Before the project imports: ebay_migration.db reads EBAY_MIGRATION_DB_URL at import time
+load_dotenv(override=True)
+
 from sqlalchemy.orm import Session
-from ebay_migration.db import init_db, ListingImage
+from ebay_migration.db import init_db, ListingImage, ListingStage
 import os
 import shutil
 
@@ -21,8 +26,16 @@ def reset_image_state():
     for img in images:
         img.local_path = None
         img.new_eps_url = None # This forces re-upload!
+        img.eps_uploaded_at = None
+        img.eps_expires_at = None
+        img.resolved_url = None # Probed again, sources that were down may be back
         count += 1
-    
+
+    # Listings not published yet need their images again
+    db.query(ListingStage).filter(ListingStage.stage.notin_(['extracted', 'published', 'verified'])).update(
+        {ListingStage.stage: 'extracted', ListingStage.images_local_at: None, ListingStage.images_eps_at: None},
+        synchronize_session=False
+    )
     db.commit()
     print(f"Reset {count} records in database.")
     
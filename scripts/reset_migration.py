@@ -1,5 +1,10 @@
+from dotenv import load_dotenv
+
+# Before the project imports: ebay_migration.db reads EBAY_MIGRATION_DB_URL at import time
+load_dotenv(override=True)
+
 from sqlalchemy.orm import Session
-from ebay_migration.db import init_db, Listing
+from ebay_migration.db import init_db, Listing, ListingStage
 
 def reset_migration_flags():
     engine = init_db()
@@ -20,6 +25,8 @@ def reset_migration_flags():
             item.migrated = False
             item.migration_error = None
             item.new_offer_id = None
+            # Stages are re-derived from the flags when the tool starts next
+            db.query(ListingStage).filter_by(listing_id=item.id).delete()
             db.commit()
             print(f"Successfully reset SKU: {sku}")
         else:
@@ -33,6 +40,7 @@ def reset_migration_flags():
                 Listing.migration_error: None,
                 Listing.new_offer_id: None
             })
+            db.query(ListingStage).delete()
             db.commit()
             print(f"Reset {count} items. You can now run Step 5 again for everything.")
     else:
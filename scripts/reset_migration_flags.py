@@ -1,5 +1,10 @@
+from dotenv import load_dotenv
+
+# Before the project imports: ebay_migration.db reads EBAY_MIGRATION_DB_URL at import time
+load_dotenv(override=True)
+
 from sqlalchemy.orm import Session
-from ebay_migration.db import init_db, Listing
+from ebay_migration.db import init_db, Listing, ListingStage
 
 def reset_flags():
     print("Resetting 'migrated' flag for ALL listings...")
@@ -8,6 +13,8 @@ def reset_flags():
     
     # Update all to False
     count = session.query(Listing).update({Listing.migrated: False})
+    # Stages are re-derived from the flags when the tool starts next
+    session.query(ListingStage).delete()
     session.commit()
     
     print(f"Successfully reset {count} listings to pending state.")